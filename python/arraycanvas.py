@@ -0,0 +1,179 @@
+from array import array
+
+import numpy
+from PIL import Image
+
+from canvas import Canvas, shrink
+
+
+# Coordinates are clamped to this range before they are truncated to pixels,
+# which keeps the Bresenham arithmetic below well inside 64-bit integers.
+# PIL's own behavior is undefined for coordinates that don't fit in an int.
+COORD_LIMIT = 1 << 28
+
+
+class ArrayCanvas(Canvas):
+    """A canvas that rasterizes into a NumPy array instead of using PIL.
+
+    Drawing is always recorded as a display list and the runs are drawn into
+    a uint8[height, width, 4] array when the canvas is flushed, which only
+    becomes an image in `get_image`. Dots and lines produce exactly the
+    pixels that ImageDraw would.
+    """
+
+    def __init__(self, scale=1, supersample=1):
+        super(ArrayCanvas, self).__init__(batched=True, scale=scale,
+                                          supersample=supersample)
+
+    def _allocate(self):
+        width, height = self.raster_size
+        self.pixels = numpy.zeros((height, width, 4), dtype=numpy.uint8)
+
+    def reset(self):
+        self.pixels.fill(0)
+        self._reset_state()
+
+    def flush(self):
+        if not self.runs:
+            return
+        display = gather(self.runs)
+        self.runs = []
+        self.buffered = 0
+        self._run_color = None
+        draw_display(display, self.pixels)
+
+    def get_image(self):
+        self.flush()
+        self.image = Image.fromarray(self.pixels, "RGBA")
+        return shrink(self.image, self.supersample)
+
+
+def gather(runs):
+    """Flatten a display list of runs into the buffers `draw_display` uses.
+
+    Returns (points, point_counts, paths, path_sizes, path_runs, inks),
+    where the counts and runs say which run every point and polyline came
+    from.
+    """
+    points, point_counts = array("d"), []
+    paths, path_sizes, path_runs = array("d"), [], []
+    for run, (color, run_points, run_paths) in enumerate(runs):
+        points.extend(run_points)
+        point_counts.append(len(run_points) // 2)
+        for path in run_paths:
+            paths.extend(path)
+            path_sizes.append(len(path) // 2)
+            path_runs.append(run)
+    inks = numpy.array([_ink(color) for color, _, _ in runs],
+                       dtype=numpy.uint8).reshape(-1, 4)
+    return points, point_counts, paths, path_sizes, path_runs, inks
+
+
+def draw_display(display, pixels, origin=(0, 0)):
+    """Draw a gathered display list into `pixels`.
+
+    `pixels` is a uint8[height, width, 4] array holding the part of the
+    image whose top left corner is at `origin`, so that an image can be
+    drawn a piece at a time with the same result as all at once.
+    """
+    points, point_counts, paths, path_sizes, path_runs, inks = display
+    height, width = pixels.shape[:2]
+
+    xs, ys = _pixels(points, origin)
+    runs = numpy.repeat(numpy.arange(len(point_counts)), point_counts)
+    if paths:
+        line_xs, line_ys, line_runs = _rasterize(
+            paths, path_sizes, path_runs, (height, width), origin)
+        xs = numpy.concatenate((xs, line_xs))
+        ys = numpy.concatenate((ys, line_ys))
+        runs = numpy.concatenate((runs, line_runs))
+
+    inside = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+    offsets = (ys * width + xs)[inside]
+    runs = runs[inside]
+    if not len(offsets):
+        return
+
+    # A pixel drawn more than once gets the ink of the last run that drew
+    # it, so keep the entry with the highest run for every pixel.
+    order = numpy.lexsort((runs, offsets))
+    offsets, runs = offsets[order], runs[order]
+    last = numpy.ones(len(offsets), dtype=bool)
+    last[:-1] = offsets[1:] != offsets[:-1]
+    pixels.reshape(-1, 4)[offsets[last]] = inks[runs[last]]
+
+
+def _pixels(coords, origin=(0, 0)):
+    """Truncate a flat array of x, y doubles toward zero, like PIL does,
+    and make them relative to `origin`."""
+    coords = numpy.frombuffer(coords, dtype=numpy.float64)
+    coords = numpy.clip(coords, -COORD_LIMIT, COORD_LIMIT).astype(numpy.int64)
+    return coords[0::2] - origin[0], coords[1::2] - origin[1]
+
+
+def _ink(color):
+    """Return an RGBA ink the way PIL fills in a color for an RGBA image."""
+    return tuple(color) + (255, ) * (4 - len(color))
+
+
+def _rasterize(paths, sizes, path_runs, shape, origin=(0, 0)):
+    """Return the pixels ImageDraw.line would set for each polyline,
+    relative to `origin`.
+
+    `paths` holds the points of every polyline one after another, with
+    `sizes` giving the number of points in each and `path_runs` the run it
+    was recorded in. Every segment is stepped along its major axis from its
+    start point to its end point inclusive, with the minor axis following
+    Bresenham's error term. Only the steps that fall inside the image along
+    the major axis are generated, so huge segments stay cheap.
+    """
+    height, width = shape
+    # Pixels are truncated before they're moved, so the lines are the same
+    # wherever the origin is.
+    x, y = _pixels(paths, origin)
+
+    # A segment joins every point to the next one in the same polyline.
+    ends = numpy.cumsum(sizes) - 1
+    joined = numpy.ones(len(x), dtype=bool)
+    joined[ends] = False
+    segments = numpy.flatnonzero(joined)
+    point_runs = numpy.repeat(path_runs, sizes)
+
+    x0, y0 = x[segments], y[segments]
+    dx, dy = x[segments + 1] - x0, y[segments + 1] - y0
+    step_x = numpy.where(dx < 0, -1, 1)
+    step_y = numpy.where(dy < 0, -1, 1)
+    dx, dy = numpy.abs(dx), numpy.abs(dy)
+
+    # PIL steps along x only when the line is strictly wider than it is tall.
+    along_x = dx > dy
+    major = numpy.where(along_x, dx, dy)
+    minor = numpy.where(along_x, dy, dx)
+    start = numpy.where(along_x, x0, y0)
+    step = numpy.where(along_x, step_x, step_y)
+    size = numpy.where(along_x, width, height)
+
+    # Restrict each segment to the steps [first, last) that land inside the
+    # image along its major axis.
+    first = numpy.where(step > 0, -start, start - size + 1)
+    first = numpy.clip(first, 0, major + 1)
+    last = numpy.where(step > 0, size - start, start + 1)
+    last = numpy.clip(last, first, major + 1)
+    counts = last - first
+
+    total = int(counts.sum())
+    if not total:
+        empty = numpy.zeros(0, dtype=numpy.int64)
+        return empty, empty, empty
+    segment = numpy.repeat(numpy.arange(len(counts)), counts)
+    offsets = numpy.cumsum(counts) - counts
+    i = numpy.arange(total) - numpy.repeat(offsets - first, counts)
+
+    # Zero length segments are a single pixel with no drift.
+    major_i = numpy.maximum(major[segment], 1)
+    drift = (2 * minor[segment] * i + major_i) // (2 * major_i)
+    xs = numpy.where(along_x[segment], i, drift)
+    ys = numpy.where(along_x[segment], drift, i)
+    return (x0[segment] + step_x[segment] * xs,
+            y0[segment] + step_y[segment] * ys,
+            point_runs[segments][segment])
@@ -0,0 +1,126 @@
+"""Time GBC programs.
+
+    python benchmark.py ../tests/trig.gbc
+    python benchmark.py --startup ../tests/circle.gbc
+    python benchmark.py --memory ../tests/circle.gbc
+
+Each program is run with every engine, first with float math and then with
+mpmath, and the best of several runs of each is printed. With --startup,
+the time it takes a new process to check each program is printed instead,
+along with the heavy modules that importing the interpreter loads. With
+--memory, the size of each program's tree is printed, as parsed and once
+optimized, in bytes per character of source.
+"""
+import argparse
+import gc
+import os
+import subprocess
+import sys
+import timeit
+import types
+
+import gbcmath
+from interpreter import ENGINES, allow_deep_calls, parse, run
+
+
+# Modules that the interpreter should only import once they're needed.
+HEAVY = ("PIL", "numpy", "mpmath", "json", "cPickle", "argparse", "compiler",
+         "vm", "canvas", "cache", "tracing")
+
+
+def best(fn, repeat):
+    return min(timeit.repeat(fn, number=1, repeat=repeat))
+
+
+def best_time(data, engine, repeat):
+    return best(lambda: run(data, engine=engine), repeat)
+
+
+def startup(paths, repeat=5):
+    here = os.path.dirname(os.path.abspath(__file__))
+    script = os.path.join(here, "interpreter.py")
+    def spawn(*args):
+        subprocess.check_call((sys.executable, ) + args, cwd=here)
+
+    empty = best(lambda: spawn("-c", "pass"), repeat)
+    print "%-20s %8.1fms" % ("(empty)", empty * 1000)
+    for path in paths:
+        path = os.path.abspath(path)
+        taken = best(lambda: spawn(script, "--check", path), repeat)
+        print "%-20s %8.1fms" % (os.path.basename(path), taken * 1000)
+
+    loaded = subprocess.check_output(
+        (sys.executable, "-c",
+         "import sys, interpreter; print ' '.join(sorted(set("
+         "m.split('.')[0] for m in sys.modules if sys.modules[m])))"),
+        cwd=here).split()
+    heavy = [m for m in HEAVY if m in loaded]
+    print "heavy imports: %s" % (", ".join(heavy) or "none")
+
+
+def deep_size(root):
+    """Return the bytes taken by `root` and everything it refers to, other
+    than classes, functions and modules."""
+    seen = set()
+    objects = [root]
+    size = 0
+    while objects:
+        obj = objects.pop()
+        if id(obj) in seen or isinstance(obj, (type, types.FunctionType,
+                                               types.ModuleType)):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        objects.extend(gc.get_referents(obj))
+    return size
+
+
+def memory(paths):
+    print "%-20s %9s %14s %14s" % ("program", "source", "parsed",
+                                   "optimized")
+    for path in paths:
+        with open(path) as file_:
+            data = file_.read()
+        sizes = [deep_size(parse(data, optimize)) for optimize in (False,
+                                                                   True)]
+        print "%-20s %8dB %8.1fB/char %8.1fB/char" % (
+            path.rsplit("/", 1)[-1], len(data),
+            float(sizes[0]) / len(data), float(sizes[1]) / len(data))
+
+
+def main(paths, repeat=5):
+    print "%-20s %-8s %9s %9s %8s" % ("program", "engine", "float",
+                                      "mpmath", "speedup")
+    for path in paths:
+        with open(path) as file_:
+            data = file_.read()
+        for engine in ENGINES:
+            gbcmath.use_mpmath(False)
+            fast = best_time(data, engine, repeat)
+            gbcmath.use_mpmath()
+            slow = best_time(data, engine, repeat)
+            print "%-20s %-8s %8.4fs %8.4fs %7.1fx" % (
+                path.rsplit("/", 1)[-1], engine, fast, slow, slow / fast)
+    gbcmath.use_mpmath(False)
+
+
+if __name__ == "__main__":
+    cli = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    cli.add_argument("programs", nargs="+", metavar="program",
+                     help="path to a program to time")
+    cli.add_argument("--repeat", type=int, default=5,
+                     help="how many times to run each program")
+    cli.add_argument("--startup", action="store_true",
+                     help="time starting the interpreter to check each "
+                          "program instead")
+    cli.add_argument("--memory", action="store_true",
+                     help="measure the memory each program's tree takes "
+                          "instead")
+    args = cli.parse_args()
+    allow_deep_calls()
+    if args.startup:
+        startup(args.programs, args.repeat)
+    elif args.memory:
+        memory(args.programs)
+    else:
+        main(args.programs, args.repeat)
@@ -1,23 +1,39 @@
 import HTMLParser
 import json
-from tempfile import NamedTemporaryFile
+from io import BytesIO
 
 from tweepy.streaming import StreamListener
 from tweepy import API, OAuthHandler, Stream
 
-from interpreter import run
+from pipeline import Job, Pipeline, Poster
 
+import settings
 from settings import (CONSUMER_TOKEN, CONSUMER_SECRET,
                       ACCESS_TOKEN, ACCESS_SECRET)
 
 
 hp = HTMLParser.HTMLParser()
 
+# How long the stream waits for room in the pipeline before dropping a tweet.
+SUBMIT_TIMEOUT = 5
 
-class Listener(StreamListener):
+
+class TwitterPoster(Poster):
 
     def __init__(self, auth):
-        self.auth = auth
+        self.api = API(auth)
+
+    def post(self, job, png):
+        # The filename only tells Twitter what kind of image it's getting.
+        self.api.update_status_with_media(
+                "gbc.png", status="@%s Here ya go!" % job.user,
+                file=BytesIO(png))
+
+
+class Listener(StreamListener):
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
 
     def on_data(self, data):
         data = json.loads(data)
@@ -26,14 +42,10 @@ class Listener(StreamListener):
         d = hp.unescape(d)
         print d
 
-        try:
-            context = run(d)
-            with NamedTemporaryFile(suffix=".png") as tf:
-                context.canvas.save(tf.name)
-                API(self.auth).update_status_with_media(
-                        tf.name, status="@%s Here ya go!" % user)
-        except Exception as e:
-            print e
+        # Popular snippets get resubmitted verbatim, so the workers cache
+        # programs and images keyed by the source left after normalizing.
+        if not self.pipeline.submit(Job(d, user), timeout=SUBMIT_TIMEOUT):
+            print "Too busy, dropped program from %s" % user
 
         return True
 
@@ -46,6 +58,14 @@ if __name__ == "__main__":
     auth = OAuthHandler(CONSUMER_TOKEN, CONSUMER_SECRET)
     auth.set_access_token(ACCESS_TOKEN, ACCESS_SECRET)
 
-    stream = Stream(auth, Listener(auth))
-    stream.filter(track=["#gbc"])
+    pipeline = Pipeline(TwitterPoster(auth),
+                        compress_level=getattr(settings, "COMPRESS_LEVEL",
+                                               None),
+                        program_cache=getattr(settings, "PROGRAM_CACHE", None),
+                        render_cache=getattr(settings, "RENDER_CACHE", None))
+    try:
+        stream = Stream(auth, Listener(pipeline))
+        stream.filter(track=["#gbc"])
+    finally:
+        pipeline.close()
 
@@ -0,0 +1,247 @@
+import cPickle as pickle
+import hashlib
+import os
+from collections import OrderedDict
+from tempfile import NamedTemporaryFile
+
+import gbcmath
+from compiler import compile
+
+
+class LRUCache(object):
+    """A mapping that forgets its least recently used entries.
+
+    The cache holds at most `max_entries` entries and, if `max_bytes` is
+    given, at most that many bytes as measured by the size passed to `put`.
+    `hits` and `misses` count the lookups made with `get`.
+    """
+
+    def __init__(self, max_entries=256, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        try:
+            value, size = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.entries[key] = value, size
+        self.hits += 1
+        return value
+
+    def put(self, key, value, size=0):
+        if key in self.entries:
+            self.bytes -= self.entries.pop(key)[1]
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        self.entries[key] = value, size
+        self.bytes += size
+        while (len(self.entries) > self.max_entries or
+               self.max_bytes is not None and self.bytes > self.max_bytes):
+            self.bytes -= self.entries.popitem(last=False)[1][1]
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    def save(self, path):
+        """Pickle the entries to `path`, replacing it atomically."""
+        directory = os.path.dirname(os.path.abspath(path))
+        with NamedTemporaryFile(dir=directory, delete=False) as file_:
+            pickle.dump(self.entries.items(), file_, pickle.HIGHEST_PROTOCOL)
+        os.rename(file_.name, path)
+
+    def load(self, path):
+        """Add the entries saved to `path`, oldest first."""
+        with open(path, "rb") as file_:
+            for key, (value, size) in pickle.load(file_):
+                self.put(key, value, size)
+
+
+def source_key(source, *options):
+    """Return a key identifying `source` as run with the given options."""
+    if isinstance(source, unicode):
+        source = source.encode("utf-8")
+    digest = hashlib.sha1(source).hexdigest()
+    return ":".join([digest] + map(str, options))
+
+
+# Bump this whenever the nodes trees are made of change, so trees pickled
+# by older versions aren't loaded.
+TREE_VERSION = 2
+
+
+class ProgramCache(object):
+    """Caches parsed programs by the hash of their source.
+
+    Trees are kept in an LRU cache bounded by entry count and by the size of
+    their pickles, and compiled programs in a second one bounded by entry
+    count. If `path` is given, trees are loaded from it, and new ones are
+    saved to it every `save_every` trees and whenever `save` is called.
+    Compiled programs only live in memory. Since the optimizer folds
+    constant math into trees, both are also keyed by `gbcmath.precision`.
+    """
+
+    def __init__(self, max_entries=256, max_bytes=16 << 20, path=None,
+                 save_every=32):
+        self.trees = LRUCache(max_entries, max_bytes)
+        self.programs = LRUCache(max_entries)
+        self.path = path
+        self.save_every = save_every
+        # The pickles of the trees cached since they were last saved.
+        self.unsaved = OrderedDict()
+        if path:
+            for key, (data, size) in self._saved().entries.iteritems():
+                try:
+                    block = pickle.loads(data)
+                except (AttributeError, EOFError, pickle.UnpicklingError):
+                    # Pickled by a version whose trees were laid out
+                    # differently, and so keyed differently too.
+                    continue
+                self.trees.put(key, block, size)
+
+    def _saved(self):
+        """Return an LRUCache of the pickled trees saved to `path`."""
+        saved = LRUCache(self.trees.max_entries, self.trees.max_bytes)
+        if os.path.exists(self.path):
+            try:
+                saved.load(self.path)
+            except (AttributeError, EOFError, pickle.UnpicklingError):
+                saved.clear()
+            # Saved by a version that saved the trees rather than their
+            # pickles; it's replaced once new trees are saved.
+            if not all(isinstance(data, str)
+                       for data, size in saved.entries.itervalues()):
+                saved.clear()
+        return saved
+
+    def save(self):
+        """Save the trees cached since the last save to `path`.
+
+        Other processes may share the file, so the trees they've saved to it
+        are kept, with the new ones counting as the most recently used.
+        """
+        if not self.path or not self.unsaved:
+            return
+        saved = self._saved()
+        for key, data in self.unsaved.iteritems():
+            saved.put(key, data, len(data))
+        saved.save(self.path)
+        self.unsaved.clear()
+
+    @property
+    def hits(self):
+        return self.trees.hits + self.programs.hits
+
+    @property
+    def misses(self):
+        return self.trees.misses + self.programs.misses
+
+    def tree(self, source, optimize, parse):
+        """Return the tree for `source`, calling `parse` if it isn't cached.
+
+        `parse(source)` should return the tree, or None if the source can't
+        be parsed, in which case nothing is cached.
+        """
+        key = source_key(source, TREE_VERSION, optimize, gbcmath.precision)
+        block = self.trees.get(key)
+        if block is None:
+            block = parse(source)
+            if block is None:
+                return None
+            data = pickle.dumps(block, pickle.HIGHEST_PROTOCOL)
+            self.trees.put(key, block, len(data))
+            if self.path:
+                self.unsaved[key] = data
+                if len(self.unsaved) >= self.save_every:
+                    self.save()
+        return block
+
+    def program(self, source, optimize, parse):
+        """Return `source` compiled to a Python function, or None."""
+        key = source_key(source, TREE_VERSION, optimize, gbcmath.precision)
+        program = self.programs.get(key)
+        if program is None:
+            block = self.tree(source, optimize, parse)
+            if block is None:
+                return None
+            program = compile(block)
+            self.programs.put(key, program)
+        return program
+
+
+# Bump this whenever a change to the interpreter changes what programs draw,
+# so renders cached by older versions aren't served.
+RENDER_VERSION = 3
+
+
+class RenderCache(object):
+    """Caches the PNG every program renders to.
+
+    Programs have no input, randomness or clock, so a source always draws
+    the same image. Images are kept in an LRU cache bounded by entry count
+    and bytes, and, if `directory` is given, also stored there as files
+    named by their key so they outlive the process.
+    """
+
+    def __init__(self, max_entries=256, max_bytes=64 << 20, directory=None):
+        self.images = LRUCache(max_entries, max_bytes)
+        self.directory = directory
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, source, draw, *options):
+        """Return the PNG for `source`, calling `draw` if it isn't cached.
+
+        `options` are whatever besides the source affects the output, such
+        as the canvas size and backend. `draw(source)` should return the PNG
+        data, or None if the source can't be run, in which case nothing is
+        cached.
+        """
+        key = source_key(source, RENDER_VERSION, *options)
+        data = self.images.get(key)
+        if data is None and self.directory:
+            data = self._read(key)
+            if data is not None:
+                self.images.put(key, data, len(data))
+        if data is not None:
+            self.hits += 1
+            return data
+
+        self.misses += 1
+        data = draw(source)
+        if data is None:
+            return None
+        self.images.put(key, data, len(data))
+        if self.directory:
+            self._write(key, data)
+        return data
+
+    def _path(self, key):
+        name = hashlib.sha1(key).hexdigest() + ".png"
+        return os.path.join(self.directory, name)
+
+    def _read(self, key):
+        try:
+            with open(self._path(key), "rb") as file_:
+                return file_.read()
+        except IOError:
+            return None
+
+    def _write(self, key, data):
+        with NamedTemporaryFile(dir=self.directory, delete=False) as file_:
+            file_.write(data)
+        os.rename(file_.name, self._path(key))
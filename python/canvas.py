@@ -1,12 +1,24 @@
+from array import array
+from io import BytesIO
 from math import cos, sin
 
 from PIL import Image, ImageColor, ImageDraw
 
 
+# Affine matrices are stored as (a, b, c, d, e, f) tuples, mapping (x, y) to
+# (a * x + c * y + e, b * x + d * y + f).
+IDENTITY = (1, 0, 0, 1, 0, 0)
+
+
 class Transform(object):
     def get(self, x, y):
         return x, y
 
+    def compose(self, matrix):
+        """Return the matrix that applies `matrix` and then this transform.
+        """
+        return matrix
+
 
 class TranslateTransform(Transform):
     def __init__(self, x, y):
@@ -15,6 +27,10 @@ class TranslateTransform(Transform):
     def get(self, x, y):
         return x + self.x, y + self.y
 
+    def compose(self, matrix):
+        a, b, c, d, e, f = matrix
+        return a, b, c, d, e + self.x, f + self.y
+
     def update(self, x, y):
         self.x += x
         self.y += y
@@ -29,6 +45,13 @@ class RotateTransform(Transform):
         return (x * cos(theta) - y * sin(theta),
                 y * cos(theta) + x * sin(theta))
 
+    def compose(self, matrix):
+        a, b, c, d, e, f = matrix
+        cos_, sin_ = cos(self.theta), sin(self.theta)
+        return (a * cos_ - b * sin_, b * cos_ + a * sin_,
+                c * cos_ - d * sin_, d * cos_ + c * sin_,
+                e * cos_ - f * sin_, f * cos_ + e * sin_)
+
     def update(self, theta):
         self.theta += theta
 
@@ -40,17 +63,91 @@ class ScaleTransform(Transform):
     def get(self, x, y):
         return x * self.x, y * self.y
 
+    def compose(self, matrix):
+        a, b, c, d, e, f = matrix
+        return (a * self.x, b * self.y, c * self.x, d * self.y,
+                e * self.x, f * self.y)
+
     def update(self, x, y):
         self.x += x
         self.y += y
 
 
+# The width and height of the image programs draw on, before scaling.
+SIZE = 500, 500
+
+# The number of coordinates a batched canvas buffers before drawing them.
+BATCH_SIZE = 1 << 16
+
+
+def scaled_size(scale):
+    """Return the size of the image a canvas drawn at `scale` produces."""
+    return int(SIZE[0] * scale), int(SIZE[1] * scale)
+
+
+def shrink(image, factor):
+    """Scale `image` down by a whole `factor`, averaging each block of
+    pixels into one."""
+    if factor == 1:
+        return image
+    width, height = image.size
+    return image.resize((width // factor, height // factor), Image.BOX)
+
+
 class Canvas(object):
+    """The image a program draws on.
 
-    def __init__(self):
-        self.image = Image.new("RGBA", (500, 500))
-        self.transforms = []
+    Programs always draw as if on a canvas of `SIZE`. The image is `scale`
+    times larger, and for antialiasing it can be drawn `supersample` times
+    larger again and shrunk back down when it's finished.
+    """
+
+    def __init__(self, batched=False, scale=1, supersample=1):
+        self.batched = batched
+        self.output_scale = scale
+        self.supersample = supersample
+        # Coordinates are multiplied by `factor` as they're drawn.
+        self.factor = scale * supersample
+        self.size = scaled_size(scale)
+        self.raster_size = (self.size[0] * supersample,
+                            self.size[1] * supersample)
+        self._allocate()
+        self._reset_state()
+
+    def _allocate(self):
+        self.image = Image.new("RGBA", self.raster_size)
         self.draw = ImageDraw.Draw(self.image)
+
+    def reset(self):
+        """Clear the canvas in place, as if it had just been made.
+
+        The image is reused, so images returned by `get_image` before the
+        reset are cleared too.
+        """
+        self.image.paste((0, 0, 0, 0), (0, 0) + self.image.size)
+        self._reset_state()
+
+    def _reset_state(self):
+        # In batched mode dots and lines are recorded as a display list of
+        # runs of (color, points, paths) with one run per change of color.
+        # Primitives of the same color overwrite pixels with the same ink, so
+        # within a run all the points are drawn with one call, followed by
+        # each unbroken polyline. Runs are drawn in the order they were
+        # recorded when the canvas is flushed.
+        self.runs = []
+        self.buffered = 0
+        self._run_color = None
+        self._points = None
+        self._paths = None
+        self._path = None
+
+        # `transforms` is the stack of transforms applied to the cursor, and
+        # `matrices[i]` caches the composition of `transforms[:i + 1]`. Both
+        # should only be changed through the methods below.
+        self.transforms = []
+        self.matrices = []
+        self.matrix = IDENTITY
+
         self.color = ImageColor.getcolor("rgb(0, 0, 0)", mode="RGB")
 
         self.last_point = 0, 0
@@ -68,47 +165,203 @@ class Canvas(object):
         #print "Moved cursor to", self.cursor
 
     def get_cursor(self, coords=None):
-        pos = 0, 0
-        for t in self.transforms:
-            pos = t.get(*pos)
-        cur_pos = coords or self.cursor
-        return pos[0] + cur_pos[0], pos[1] + cur_pos[0]
+        # The transforms move the origin, and the cursor is offset from it.
+        x, y = coords or self.cursor
+        matrix = self.matrix
+        if self.factor != 1:
+            factor = self.factor
+            return (matrix[4] + x) * factor, (matrix[5] + y) * factor
+        return matrix[4] + x, matrix[5] + y
 
     def clear_transforms(self):
         self.transforms = []
+        self.matrices = []
+        self.matrix = IDENTITY
 
     def pop(self):
         self.transforms.pop()
+        self.matrices.pop()
+        self.matrix = self.matrices[-1] if self.matrices else IDENTITY
+
+    def _push(self, transform):
+        self.transforms.append(transform)
+        self.matrix = transform.compose(self.matrix)
+        self.matrices.append(self.matrix)
+
+    def _update(self):
+        """Recompose the matrix after the top transform has been updated."""
+        below = self.matrices[-2] if len(self.matrices) > 1 else IDENTITY
+        self.matrix = self.matrices[-1] = self.transforms[-1].compose(below)
+
+    def replace(self, transform):
+        """Replace the top transform with `transform`."""
+        self.transforms[-1] = transform
+        self._update()
 
     def translate(self, x, y):
         if self.transforms and isinstance(self.transforms[-1],
                                           TranslateTransform):
             self.transforms[-1].update(x, y)
+            self._update()
             return
-        self.transforms.append(TranslateTransform(x, y))
+        self._push(TranslateTransform(x, y))
 
     def rotate(self, theta):
         if self.transforms and isinstance(self.transforms[-1], RotateTransform):
             self.transforms[-1].update(theta)
+            self._update()
             return
-        self.transforms.append(RotateTransform(theta))
+        self._push(RotateTransform(theta))
 
     def scale(self, x_scale, y_scale):
         if self.transforms and isinstance(self.transforms[-1], ScaleTransform):
             self.transforms[-1].update(x_scale, y_scale)
+            self._update()
             return
-        self.transforms.append(ScaleTransform(x_scale, y_scale))
+        self._push(ScaleTransform(x_scale, y_scale))
 
     def dot(self):
         cursor = self.get_cursor()
-        self.draw.point(cursor, fill=self.color)
+        if self.batched:
+            if self.color != self._run_color:
+                self._start_run()
+            self._points.extend(cursor)
+            self._path = None
+            self.buffered += 2
+            if self.buffered >= BATCH_SIZE:
+                self.flush()
+        else:
+            self.draw.point(cursor, fill=self.color)
         self.last_point = cursor
 
     def line(self):
         cursor = self.get_cursor()
-        self.draw.line([self.last_point, cursor],
-                       fill=self.color)
+        if self.batched:
+            if self.color != self._run_color:
+                self._start_run()
+            if self._path is None:
+                self._path = array("d", self.last_point)
+                self._paths.append(self._path)
+            self._path.extend(cursor)
+            self.buffered += 2
+            if self.buffered >= BATCH_SIZE:
+                self.flush()
+        else:
+            self.draw.line([self.last_point, cursor],
+                           fill=self.color)
         self.last_point = cursor
 
-    def save(self, path):
-        self.image.save(path)
+    def plot(self, xs, ys, lines):
+        """Draw at each of the points (xs[i], ys[i]) in turn, as `dot` or,
+        where lines[i] is true, `line` would with the cursor there.
+
+        The points are where the transforms have moved the cursor to, like
+        `get_cursor` returns before scaling them, and everything is drawn
+        in the current color. Loops that have been worked out all at once
+        draw with this.
+        """
+        if self.factor != 1:
+            factor = self.factor
+            xs = [x * factor for x in xs]
+            ys = [y * factor for y in ys]
+        if self.batched and self.color != self._run_color:
+            self._start_run()
+
+        # Consecutive lines are drawn as one polyline, which PIL draws a
+        # segment at a time just as if they had been drawn separately.
+        path = self._path if self.batched else None
+        points, paths = array("d"), []
+        last = self.last_point
+        for point, line in zip(zip(xs, ys), lines):
+            if line:
+                if path is None:
+                    path = array("d", last)
+                    paths.append(path)
+                path.extend(point)
+            else:
+                points.extend(point)
+                path = None
+            last = point
+        self.last_point = last
+
+        if not self.batched:
+            if points:
+                self.draw.point(points.tolist(), fill=self.color)
+            for path in paths:
+                self.draw.line(path.tolist(), fill=self.color)
+            return
+        self._points.extend(points)
+        self._paths.extend(paths)
+        self._path = path
+        self.buffered += 2 * len(xs)
+        if self.buffered >= BATCH_SIZE:
+            self.flush()
+
+    def _start_run(self):
+        self._run_color = self.color
+        self._points = array("d")
+        self._paths = []
+        self._path = None
+        self.runs.append((self._run_color, self._points, self._paths))
+
+    def flush(self):
+        """Draw everything recorded in batched mode onto the image."""
+        for color, points, paths in self.runs:
+            if points:
+                self.draw.point(points.tolist(), fill=color)
+            for path in paths:
+                self.draw.line(path.tolist(), fill=color)
+        self.runs = []
+        self.buffered = 0
+        self._run_color = None
+
+    def get_image(self):
+        """Return the finished image, with everything drawn onto it."""
+        self.flush()
+        return shrink(self.image, self.supersample)
+
+    def save(self, path, format=None):
+        self.get_image().save(path, format)
+
+    def to_bytes(self, format="png", compress_level=None, optimize=False):
+        """Return the image encoded as `format`, without touching the disk.
+
+        For PNGs, `compress_level` runs from 0 (fastest) to 9 (smallest)
+        and `optimize` spends extra time looking for a smaller encoding.
+        """
+        options = {}
+        if compress_level is not None:
+            options["compress_level"] = compress_level
+        if optimize:
+            options["optimize"] = True
+        output = BytesIO()
+        self.get_image().save(output, format.upper(), **options)
+        return output.getvalue()
+
+
+class CanvasPool(object):
+    """Lends out canvases and takes them back to reuse, so that running one
+    program after another doesn't allocate a new image for each.
+
+    `make` is called to make a canvas when none are free. Up to `max_free`
+    returned canvases are kept, reset, until they're borrowed again.
+    `created` counts the canvases made.
+    """
+
+    def __init__(self, make=Canvas, max_free=4):
+        self.make = make
+        self.max_free = max_free
+        self.free = []
+        self.created = 0
+
+    def borrow(self):
+        try:
+            return self.free.pop()
+        except IndexError:
+            self.created += 1
+            return self.make()
+
+    def release(self, canvas):
+        if len(self.free) < self.max_free:
+            canvas.reset()
+            self.free.append(canvas)
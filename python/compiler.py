@@ -0,0 +1,534 @@
+import __builtin__
+import math
+
+import gbcmath
+from contexts import (MISS, StackOverflow, restore_arguments,
+                      save_arguments)
+from operations import *
+
+
+class CompilerError(Exception):
+    pass
+
+
+class _NeedsDict(Exception):
+    """Raised when a program cannot keep its variables in Python locals."""
+    pass
+
+
+def _assign(vars_, id_, value):
+    vars_[id_] = value
+    return value
+
+
+def _assign_slotted(context, id_, value):
+    slot = context.slot_index.get(id_)
+    if slot is None:
+        context.vars_[id_] = value
+    else:
+        context.slots[slot] = value
+        context.assigned[slot] = True
+    return value
+
+
+def _assign_slot(slots, assigned, index, value):
+    slots[index] = value
+    assigned[index] = True
+    return value
+
+
+def _lookup_slotted(context, id_):
+    slot = context.slot_index.get(id_)
+    if slot is None:
+        return context.vars_.get(id_, 0)
+    return context.slots[slot]
+
+
+def _call(context, func, args):
+    funcs, vars_, frames = context.funcs, context.vars_, context.frames
+    if func not in funcs:
+        raise Exception("Function `%d` not yet defined." % func)
+    function = funcs[func]
+    # Context.push_frame, inlined as this is run for every call.
+    if not frames:
+        for idx, arg in enumerate(reversed(args)):
+            vars_[(idx + 1) * -1] = arg
+        saved = None
+    elif len(frames) < context.MAX_DEPTH:
+        saved = save_arguments(vars_, args)
+    else:
+        raise StackOverflow(len(frames))
+    frames.append(saved)
+    try:
+        cache = None
+        if function.reads is not None:
+            cache = context.call_cache(func, function)
+            key, out = cache.lookup(vars_)
+            if out is not MISS:
+                return out
+        budget = context.budget
+        if budget is None:
+            out = function()
+        else:
+            budget.enter(context)
+            try:
+                out = function()
+            finally:
+                budget.leave()
+    except RuntimeError as e:
+        if "recursion" not in str(e):
+            raise
+        # Python's stack ran out before the context's depth limit.
+        raise StackOverflow(len(frames))
+    finally:
+        frames.pop()
+        if saved:
+            restore_arguments(vars_, saved)
+    if cache is not None:
+        cache.store(key, out)
+    return out
+
+
+def _call_value(context, out):
+    if isinstance(out, tuple):
+        return _call(context, out[0], out[1:])
+    return _call(context, out, ())
+
+
+class _CompiledCall(CallOperation):
+    """A call in a node that's run by its tree walking `run()` method, made
+    to the compiled function rather than to a FunctionBlock."""
+
+    def __init__(self, call):
+        super(_CompiledCall, self).__init__()
+        self.body = call.body
+        self.position = call.position
+
+    def run(self, context):
+        return _call_value(context, self.body.run(context))
+
+
+def _hoist(values, value):
+    values.append(value)
+    return value
+
+
+def _hsl(h, s, l, a=255):
+    return hsl_to_rgb(h, s, l)
+
+
+_UNSET = object()
+
+HELPERS = {
+    "BreakInterrupt": BreakInterrupt,
+    "_UNSET": _UNSET,
+    "_hoist": _hoist,
+    "_assign": _assign,
+    "_assign_slot": _assign_slot,
+    "_assign_slotted": _assign_slotted,
+    "_lookup_slotted": _lookup_slotted,
+    "_call": _call,
+    "_call_value": _call_value,
+    "_hsl": _hsl,
+    "_sin": math.sin,
+    "_cos": math.cos,
+    "_tan": math.tan,
+    "_asin": math.asin,
+    "_acos": math.acos,
+    "_atan": math.atan,
+    # Looked up on the module as they're called, so that programs follow
+    # `gbcmath.use_mpmath()` even once they're compiled and cached.
+    "_math": gbcmath,
+    "_floor": math.floor,
+    "_ceil": math.ceil,
+    "_sqrt": math.sqrt,
+    "_pow": pow,
+}
+
+INFIX = {
+    PlusOperation: "+",
+    MultOperation: "*",
+    DivOperation: "/",
+    SubOperation: "-",
+    ModOperation: "%",
+    PowOperation: "**",
+    GTOperation: ">",
+    GTEOperation: ">=",
+    EqualOperation: "==",
+    DNEOperation: "!=",
+}
+
+PREFIX_CALLS = {
+    SinOperation: "_sin",
+    CosOperation: "_cos",
+    TanOperation: "_tan",
+    SecOperation: "_math.sec",
+    CscOperation: "_math.csc",
+    CotOperation: "_math.cot",
+    FloorOperation: "_floor",
+    CeilOperation: "_ceil",
+}
+
+INVERSES = {
+    SinOperation: "_asin",
+    CosOperation: "_acos",
+    TanOperation: "_atan",
+    SecOperation: "_math.asec",
+    CscOperation: "_math.acsc",
+    CotOperation: "_math.acot",
+}
+
+CANVAS_CALLS = {
+    DotStatement: "_dot",
+    PathStatement: "_line",
+    ClearMatStatement: "_clear",
+    PopMatStatement: "_pop",
+}
+
+
+class Compiler(object):
+    """Translates a syntax tree into the source of a Python function.
+
+    Nodes that the compiler doesn't know how to translate (or that are
+    malformed and would raise at runtime) are called through their tree
+    walking `run()` method, so compiled programs behave exactly like
+    interpreted ones.
+    """
+
+    def __init__(self, block, use_locals=True):
+        self.tree = block
+        self.lines = []
+        self.nodes = []
+        self.constants = []
+        self.functions = 0
+        self.hoisted = {}
+        self.variables = {}
+        self.assigned = set()
+        # Keys computed at runtime have to be checked against the slots.
+        self.slotted = isinstance(block, SlottedBlock)
+        self.use_locals = use_locals and self._can_use_locals(block)
+
+    @staticmethod
+    def _can_use_locals(block):
+        for node in walk(block):
+            if isinstance(node, (FunctionBlock, CallOperation)):
+                return False
+            if isinstance(node, AssignOperation):
+                key = node.body
+                if isinstance(key, Continuation):
+                    key = key.value[0] if key.value else None
+                if not isinstance(key, Literal):
+                    return False
+        return True
+
+    def emit(self, line, indent):
+        self.lines.append("    " * indent + line)
+
+    def fallback(self, node):
+        if self.use_locals and any(
+                isinstance(n, (AssignOperation, SlotRead, SlotWrite))
+                for n in walk(node)):
+            raise _NeedsDict()
+        self.nodes.append(replace_calls(node, _CompiledCall))
+        return "_n[%d].run(context)" % (len(self.nodes) - 1)
+
+    def variable(self, key):
+        if key not in self.variables:
+            self.variables[key] = "v%d" % len(self.variables), repr(key)
+        return self.variables[key][0]
+
+    def assign_local(self, key, value, indent):
+        # Each variable that's assigned to has a flag saying whether it
+        # has been, so that only those that were are stored back.
+        self.assigned.add(key)
+        name = self.variable(key)
+        self.emit("%s = %s" % (name, value), indent)
+        self.emit("%s_set = True" % name, indent)
+
+    def literal(self, value):
+        if type(value) in (int, long, bool) or (type(value) is float and
+                                                not math.isinf(value) and
+                                                not math.isnan(value)):
+            return "(%r)" % value if value < 0 else repr(value)
+        self.constants.append(value)
+        return "_c[%d]" % (len(self.constants) - 1)
+
+    def expr(self, node):
+        if isinstance(node, Literal):
+            return self.literal(node.value)
+
+        if isinstance(node, PowOperation) and not node.cheap_to_fold():
+            # Python would work out `literal ** literal` as it compiles.
+            return "_pow(%s, %s)" % (self.expr(node.left),
+                                     self.expr(node.right))
+        if isinstance(node, InfixOperation) and type(node) in INFIX:
+            return "(%s %s %s)" % (self.expr(node.left), INFIX[type(node)],
+                                   self.expr(node.right))
+        if isinstance(node, Continuation):
+            return "(%s, )" % ", ".join(self.expr(v) for v in node.value)
+
+        if type(node) in PREFIX_CALLS:
+            return "%s(%s)" % (PREFIX_CALLS[type(node)], self.expr(node.body))
+        if isinstance(node, NegateOperation):
+            return "(%s * -1)" % self.expr(node.body)
+        if isinstance(node, NotOperation):
+            return "(%s == 0)" % self.expr(node.body)
+        if isinstance(node, SquareOperation):
+            return "(%s ** 2)" % self.expr(node.body)
+        args = tuple_arguments(node, AndOperation, 2)
+        if args:
+            return "(0 if %s == 0 else %s)" % tuple(map(self.expr, args))
+        args = tuple_arguments(node, OrOperation, 2)
+        if args:
+            return "(%s or %s)" % tuple(map(self.expr, args))
+        args = tuple_arguments(node, IffOperation, 3)
+        if args:
+            condition, left, right = map(self.expr, args)
+            return "(%s if %s else %s)" % (left, condition, right)
+        args = tuple_arguments(node, XOROperation, 2)
+        if args:
+            return "(bool(%s) != bool(%s))" % tuple(map(self.expr, args))
+        if (isinstance(node, TrigInverterOperation) and
+                type(node.body) in INVERSES):
+            return "%s(%s)" % (INVERSES[type(node.body)],
+                               self.expr(node.body.body))
+        if isinstance(node, SqRootOperation):
+            if tuple_values(node.body, 2):
+                return "(%s ** (1 / %s))" % tuple(map(self.expr,
+                                                      node.body.value))
+            if not isinstance(node.body, Continuation):
+                return "_sqrt(%s)" % self.expr(node.body)
+        if isinstance(node, HoistedExpression):
+            if node not in self.hoisted:
+                return self.expr(node.expr)
+            return "(%s[0] if %s else _hoist(%s, %s))" % (
+                self.hoisted[node], self.hoisted[node], self.hoisted[node],
+                self.expr(node.expr))
+        if isinstance(node, AssignOperation):
+            return self.assign_expr(node)
+        if isinstance(node, SlotRead):
+            if self.use_locals:
+                return self.variable(node.key)
+            return "slots[%d]" % node.index
+        if isinstance(node, SlotWrite):
+            if self.use_locals:
+                raise _NeedsDict()
+            return "_assign_slot(slots, assigned, %d, %s)" % (
+                node.index, self.expr(node.value))
+        if isinstance(node, CallOperation):
+            if isinstance(node.body, Continuation):
+                args = map(self.expr, node.body.value)
+                return "_call(context, %s, (%s))" % (
+                    args[0], "".join(a + ", " for a in args[1:]))
+            return "_call_value(context, %s)" % self.expr(node.body)
+
+        return self.fallback(node)
+
+    def assign_expr(self, node):
+        if tuple_values(node.body, 2):
+            if self.use_locals:
+                # Python 2 can't rebind a local inside of an expression.
+                raise _NeedsDict()
+            key, value = map(self.expr, node.body.value)
+            if self.slotted and not isinstance(node.body.value[0], Literal):
+                return "_assign_slotted(context, %s, %s)" % (key, value)
+            return "_assign(vars_, %s, %s)" % (key, value)
+        if isinstance(node.body, Continuation):
+            return self.fallback(node)
+        if self.use_locals:
+            return self.variable(node.body.value)
+        if self.slotted and not isinstance(node.body, Literal):
+            return "_lookup_slotted(context, %s)" % self.expr(node.body)
+        return "vars_.get(%s, 0)" % self.expr(node.body)
+
+    def condition(self, node):
+        if isinstance(node, (Literal, Expression)):
+            return self.expr(node)
+        return "%s != 0" % self.expr(node)
+
+    def block(self, body, indent, loop):
+        start = len(self.lines)
+        for node in body:
+            self.stmt(node, indent, loop)
+        if len(self.lines) == start:
+            self.emit("pass", indent)
+
+    def stmt(self, node, indent, loop):
+        if isinstance(node, Literal):
+            return
+
+        if isinstance(node, AssignOperation) and tuple_values(node.body, 2):
+            key, value = node.body.value
+            if self.use_locals:
+                self.assign_local(key.value, self.expr(value), indent)
+            elif isinstance(key, Literal):
+                self.emit("vars_[%s] = %s" % (self.expr(key),
+                                              self.expr(value)), indent)
+            else:
+                self.emit(self.expr(node), indent)
+            return
+
+        if isinstance(node, SlotWrite):
+            if self.use_locals:
+                self.assign_local(node.key, self.expr(node.value), indent)
+            else:
+                self.emit("slots[%d] = %s" % (node.index,
+                                              self.expr(node.value)), indent)
+                self.emit("assigned[%d] = True" % node.index, indent)
+            return
+
+        args = tuple_arguments(node, RGBStatement, 3, 4)
+        if args:
+            mode = "rgba" if len(args) == 4 else "rgb"
+            self.emit("_set_color(%s, mode=%r)" %
+                          (", ".join(map(self.expr, args)), mode), indent)
+            return
+        args = tuple_arguments(node, HSLStatement, 3, 4)
+        if args:
+            self.emit("_set_color(*_hsl(%s), mode='rgb')" %
+                          ", ".join(map(self.expr, args)), indent)
+            return
+        args = tuple_arguments(node, CursorStatement, 2)
+        if args:
+            self.emit("_set_cursor(%s, %s)" % tuple(map(self.expr, args)),
+                      indent)
+            return
+        args = tuple_arguments(node, TranslateStatement, 2)
+        if args:
+            self.emit("_translate(%s, %s)" % tuple(map(self.expr, args)),
+                      indent)
+            return
+
+        if isinstance(node, BreakStatement):
+            self.emit("break" if loop else "raise BreakInterrupt()", indent)
+        elif type(node) in CANVAS_CALLS:
+            self.emit("%s()" % CANVAS_CALLS[type(node)], indent)
+        elif isinstance(node, ScaleStatement) and tuple_values(node.body, 2):
+            self.emit("_scale(%s, %s)" %
+                          tuple(map(self.expr, node.body.value)), indent)
+        elif isinstance(node, RotateStatement):
+            self.emit("_rotate(%s)" % self.expr(node.body), indent)
+
+        elif isinstance(node, LoopBlock):
+            self.loop(node, indent)
+        elif isinstance(node, ConditionalBlock):
+            self.emit("if %s:" % self.condition(node.first), indent)
+            self.block(node.body, indent + 1, loop)
+        elif isinstance(node, FunctionBlock):
+            self.function(node, indent)
+        elif type(node) is BlockOperation:
+            for op in node.body:
+                self.stmt(op, indent, loop)
+
+        elif isinstance(node, (Expression, Statement)):
+            self.emit(self.expr(node), indent)
+        else:
+            self.emit(self.fallback(node), indent)
+
+    def loop(self, node, indent):
+        # A `;` inside of a function called from this loop is raised as an
+        # exception, so only pay for the handler when it can happen.
+        catch = any(isinstance(n, CallOperation) for n in walk(node))
+        if catch:
+            self.emit("try:", indent)
+            indent += 1
+        # Each hoisted value is kept in a list that's empty until the
+        # expression is first reached.
+        for h in node.hoisted:
+            self.hoisted[h] = name = "_h%d" % len(self.hoisted)
+            self.emit("%s = []" % name, indent)
+        self.emit("for _ in xrange(%s):" % self.expr(node.first), indent)
+        self.emit("if budget is not None:", indent + 1)
+        self.emit("budget.step(context)", indent + 2)
+        self.block(node.body, indent + 1, True)
+        if catch:
+            self.emit("except BreakInterrupt:", indent - 1)
+            self.emit("pass", indent)
+
+    def function(self, node, indent):
+        name = "_f%d" % self.functions
+        self.functions += 1
+        self.emit("def %s():" % name, indent)
+        body = list(node.body)
+        last = body.pop() if body else None
+        for op in body:
+            self.stmt(op, indent + 1, False)
+        if isinstance(last, (Literal, Expression)):
+            self.emit("return %s" % self.expr(last), indent + 1)
+        else:
+            if last is not None:
+                self.stmt(last, indent + 1, False)
+            self.emit("return 0", indent + 1)
+        # Looking a call up costs more than a compiled expression does, so
+        # only pure functions with loops in them are worth caching.
+        reads = node.reads
+        if not any(isinstance(n, LoopBlock) for n in walk(node)):
+            reads = None
+        self.emit("%s.reads = %r" % (name, reads), indent)
+        if reads is not None:
+            # A new `_fN` is made every time the definition runs, so its
+            # calls are cached by the node it was compiled from.
+            self.nodes.append(node)
+            self.emit("%s.source = _n[%d]" % (name, len(self.nodes) - 1),
+                      indent)
+        self.emit("funcs[%s] = %s" % (self.expr(node.first), name), indent)
+
+    def source(self):
+        self.block(self.tree.body, 2, False)
+        body = self.lines
+        self.lines = []
+
+        self.emit("def program(context):", 0)
+        self.emit("vars_ = context.vars_", 1)
+        self.emit("funcs = context.funcs", 1)
+        self.emit("canvas = context.canvas", 1)
+        self.emit("budget = context.budget", 1)
+        for name, method in [("_dot", "dot"), ("_line", "line"),
+                             ("_clear", "clear_transforms"), ("_pop", "pop"),
+                             ("_set_color", "set_color"),
+                             ("_set_cursor", "set_cursor"),
+                             ("_translate", "translate"),
+                             ("_rotate", "rotate"), ("_scale", "scale")]:
+            self.emit("%s = canvas.%s" % (name, method), 1)
+        for name, key in sorted(self.variables.values()):
+            self.emit("%s = vars_.get(%s, 0)" % (name, key), 1)
+        for key in sorted(self.assigned):
+            self.emit("%s_set = False" % self.variable(key), 1)
+        if self.slotted and not self.use_locals:
+            self.emit("slots = context.use_slots(_slots)", 1)
+            self.emit("assigned = context.assigned", 1)
+        self.emit("try:", 1)
+        self.lines.extend(body)
+        self.emit("finally:", 1)
+        self.emit("pass", 2)
+        for key in sorted(self.assigned):
+            name = self.variable(key)
+            self.emit("if %s_set:" % name, 2)
+            self.emit("vars_[%r] = %s" % (key, name), 3)
+        if self.slotted and not self.use_locals:
+            self.emit("context.store_slots()", 2)
+        return "\n".join(self.lines) + "\n"
+
+
+def compile(block):
+    """Compile a parsed program into a callable that accepts a context."""
+    try:
+        compiler = Compiler(block)
+        source = compiler.source()
+    except _NeedsDict:
+        compiler = Compiler(block, use_locals=False)
+        source = compiler.source()
+
+    namespace = dict(HELPERS)
+    namespace["_n"] = compiler.nodes
+    namespace["_c"] = compiler.constants
+    namespace["_slots"] = getattr(block, "slots", None)
+    try:
+        code = __builtin__.compile(source, "<gbc>", "exec")
+    except SyntaxError as e:
+        raise CompilerError("Could not compile program: %s" % e)
+    exec code in namespace
+
+    program = namespace["program"]
+    program.source = source
+    return program
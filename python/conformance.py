@@ -0,0 +1,81 @@
+"""Check that every engine runs programs exactly like the tree walker.
+
+    python conformance.py [program ...]
+
+Each program, every one in ../tests by default, is run with every engine,
+both optimized and not, and by the tree engine with its loops vectorized.
+The image each run draws and the variables it leaves behind are compared
+with those of the tree engine's run of the unoptimized tree, and any that
+differ are printed. Exits with status 1 if any do, so run it before
+committing a change to any engine.
+
+Besides drawings, ../tests has programs that take the paths engines are
+likeliest to get wrong: nodes the compiler and VM can't lower that make
+calls, breaks out of calls, recursion that unwinds or overflows, and
+programs the compiler can't keep in Python locals.
+"""
+import glob
+import os
+import sys
+
+from interpreter import ENGINES, allow_deep_calls, run
+
+
+# Each run that's checked, as an engine and whether to vectorize loops.
+RUNS = [(engine, False) for engine in ENGINES if engine != "tree"]
+RUNS.append(("tree", True))
+
+TESTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+                     "tests")
+
+
+def outcome(data, engine, optimize, vectorize=False):
+    """Return what running `data` draws and sets, or the error it raises.
+
+    Only the type of an error is compared, as messages like Python's about
+    recursion depend on how the engine got there.
+    """
+    try:
+        context = run(data, engine=engine, optimize=optimize,
+                      vectorize=vectorize)
+    except Exception as e:
+        return "raised %s" % type(e).__name__
+    return (context.canvas.get_image().tobytes(),
+            repr(sorted(context.vars_.items())))
+
+
+def check(path):
+    """Print and return the runs of `path` that differ from the tree's."""
+    with open(path) as file_:
+        data = file_.read()
+    failures = []
+    expected = outcome(data, "tree", False)
+    for optimize in (False, True):
+        runs = RUNS + [("tree", False)] if optimize else RUNS
+        for engine, vectorize in runs:
+            got = outcome(data, engine, optimize, vectorize)
+            if got == expected:
+                continue
+            if isinstance(got, str):
+                problem = got
+            elif not isinstance(expected, tuple):
+                problem = "ran, but the tree engine %s" % expected
+            elif got[0] != expected[0]:
+                problem = "drew a different image"
+            else:
+                problem = "set different variables"
+            failures.append((engine, optimize, vectorize))
+            print "%s: %s%s%s %s" % (os.path.basename(path), engine,
+                                     " (vectorized)" if vectorize else "",
+                                     "" if optimize else " (unoptimized)",
+                                     problem)
+    return failures
+
+
+if __name__ == "__main__":
+    allow_deep_calls()
+    paths = sys.argv[1:] or sorted(glob.glob(os.path.join(TESTS, "*.gbc")))
+    failures = sum((check(path) for path in paths), [])
+    print "%d programs, %d runs differ from the tree engine's" % (
+        len(paths), len(failures))
+    sys.exit(1 if failures else 0)
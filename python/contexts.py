@@ -1,12 +1,317 @@
-from canvas import Canvas
+import time
+
+
+class BudgetExceeded(Exception):
+    """Raised when a program goes over one of the limits in its budget.
+
+    `resource` names the limit that was hit, and `steps`, `seconds`,
+    `variables` and `depth` record how far the program got.
+    """
+
+    def __init__(self, resource, limit, steps, seconds, variables, depth):
+        self.resource = resource
+        self.limit = limit
+        self.steps = steps
+        self.seconds = seconds
+        self.variables = variables
+        self.depth = depth
+        super(BudgetExceeded, self).__init__(
+            "Exceeded the %s limit of %s after %d steps and %.2f seconds, "
+            "with %d variables and %d nested calls" %
+            (resource, limit, steps, seconds, variables, depth))
+
+
+class Budget(object):
+    """Limits on the resources a program may use.
+
+    `steps` caps the number of loop iterations and function calls, `seconds`
+    how long the program may run for, `variables` how many variables it may
+    set and `depth` how deeply its function calls may nest. A limit of None
+    means no limit. Engines call `step` at every loop iteration and `enter`
+    and `leave` around every function call. To keep that cheap, the time and
+    variable limits are only checked every CHECK_INTERVAL steps.
+    """
+
+    CHECK_INTERVAL = 1024
+
+    def __init__(self, steps=None, seconds=None, variables=None, depth=None):
+        self.max_steps = steps
+        self.max_seconds = seconds
+        self.max_variables = variables
+        self.max_depth = depth
+        self.start()
+
+    def start(self):
+        self.steps = 0
+        self.depth = 0
+        self.started = time.time()
+        self.next_check = 0
+
+    def step(self, context):
+        self.steps += 1
+        if self.steps >= self.next_check:
+            self.check(context)
+
+    def allows(self, steps):
+        """Return whether `steps` more steps fit under the step limit and
+        the time limit hasn't been reached yet."""
+        if self.max_steps is not None and self.steps + steps > self.max_steps:
+            return False
+        return (self.max_seconds is None or
+                time.time() - self.started <= self.max_seconds)
+
+    def leap(self, context, steps):
+        """Take `steps` steps at once and return True, or return False
+        without taking any if that would go over the step limit, so that
+        they can be taken one at a time up to it."""
+        if self.max_steps is not None and self.steps + steps > self.max_steps:
+            return False
+        self.steps += steps
+        if self.steps >= self.next_check:
+            self.check(context)
+        return True
+
+    def check(self, context):
+        if self.max_steps is not None and self.steps > self.max_steps:
+            raise self.exceeded("step", self.max_steps, context)
+        if (self.max_seconds is not None and
+                time.time() - self.started > self.max_seconds):
+            raise self.exceeded("time", self.max_seconds, context)
+        if (self.max_variables is not None and
+                len(context.vars_) > self.max_variables):
+            raise self.exceeded("variable", self.max_variables, context)
+
+        self.next_check = self.steps + self.CHECK_INTERVAL
+        if self.max_steps is not None:
+            self.next_check = min(self.next_check, self.max_steps + 1)
+
+    def enter(self, context):
+        self.depth += 1
+        if self.max_depth is not None and self.depth > self.max_depth:
+            raise self.exceeded("call depth", self.max_depth, context)
+        self.step(context)
+
+    def leave(self):
+        self.depth -= 1
+
+    def exceeded(self, resource, limit, context):
+        return BudgetExceeded(resource, limit, self.steps,
+                              time.time() - self.started, len(context.vars_),
+                              self.depth)
+
+
+class StackOverflow(Exception):
+    """Raised when function calls nest deeper than `Context.MAX_DEPTH`, or
+    than Python's stack lets an engine that recurses on it follow."""
+
+    def __init__(self, depth):
+        self.depth = depth
+        super(StackOverflow, self).__init__(
+            "Function calls nested too deeply (%d calls)" % depth)
+
+
+# Returned by `CallCache.lookup` for calls it hasn't seen.
+MISS = type("Miss", (object,), {"__repr__": lambda self: "MISS"})()
+
+
+class CallCache(object):
+    """Remembers what a pure function returned.
+
+    A pure function's result depends only on the arguments it reads, the
+    variables with the negative keys in `reads`, so results are kept by
+    their values, for up to `size` different ones. `hits` and `misses`
+    count the calls that were answered from the cache and that weren't.
+    `func` is the key the function was first called by.
+    """
+
+    SIZE = 4096
+
+    def __init__(self, func, reads, size=SIZE):
+        self.func = func
+        self.reads = reads
+        self.size = size
+        self.results = {}
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, vars_):
+        """Return a (key, result) pair for a call with the arguments in
+        `vars_`, where `result` is MISS if the call hasn't been seen."""
+        values = tuple([vars_.get(key, 0) for key in self.reads])
+        types = tuple(map(type, values))
+        # 1 and 1.0 are the same key to a dict but not to a program, so
+        # their types are part of the key. 0.0 and -0.0 even have the same
+        # type, so calls passing a float zero aren't cached at all.
+        if float in types and 0 in values and any(
+                v == 0 and type(v) is float for v in values):
+            self.misses += 1
+            return None, MISS
+        key = values + types
+        result = self.results.get(key, MISS)
+        if result is MISS:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return key, result
+
+    def store(self, key, result):
+        if key is not None and len(self.results) < self.size:
+            self.results[key] = result
+
+    @property
+    def hit_rate(self):
+        calls = self.hits + self.misses
+        return float(self.hits) / calls if calls else 0.0
+
+
+# Stands in for an argument variable that wasn't set before a call.
+_UNSET = object()
+
+
+def save_arguments(vars_, args):
+    """Pass `args` in the argument variables of `vars_` and return what
+    they held before, for `restore_arguments`."""
+    saved = []
+    key = 0
+    for arg in reversed(args):
+        key -= 1
+        saved.append(vars_.get(key, _UNSET))
+        vars_[key] = arg
+    return saved
+
+
+def restore_arguments(vars_, saved):
+    """Put back the argument variables that `save_arguments` saved."""
+    key = 0
+    for value in saved:
+        key -= 1
+        if value is _UNSET:
+            del vars_[key]
+        else:
+            vars_[key] = value
 
 
 class Context(object):
-    def __init__(self):
+    """The state of a running program.
+
+    If `pool` is given, the canvas is borrowed from it and `close` gives it
+    back. If `vectorize` is true, loops that can be are run all at once with
+    NumPy.
+    """
+
+    # How deeply function calls may nest. The tree and compile engines
+    # recurse on Python's stack for each call, so this is kept low enough for
+    # them to reach it too (see `allow_deep_calls` in interpreter.py).
+    MAX_DEPTH = 500
+
+    def __init__(self, canvas=None, budget=None, pool=None, vectorize=False):
         self.vars_ = {}
         self.funcs = {}
         self.counter = 0
-        self.canvas = Canvas()
+        if canvas is None:
+            if pool is not None:
+                canvas = pool.borrow()
+            else:
+                # Imported here so that parsing doesn't have to load PIL.
+                from canvas import Canvas
+                canvas = Canvas()
+        self.canvas = canvas
+        self.pool = pool
+        self.budget = budget
+        self.vectorize = vectorize
+        # Maps each pure function that has been called to its CallCache.
+        self.call_caches = {}
+        # What each call in progress overwrote in the argument variables,
+        # or None for calls made from outside of any function.
+        self.frames = []
+        if budget is not None:
+            budget.start()
+
+        # Variables with literal keys are kept in `slots` while a program
+        # runs, and `slot_index` maps their keys to their slots. Whatever
+        # assigns to a slot also sets its flag in `assigned`.
+        self.slots = []
+        self.assigned = []
+        self.slot_index = {}
+
+    def use_slots(self, slot_index):
+        """Move the variables named in `slot_index` into slots."""
+        slots = [0] * len(slot_index)
+        assigned = [False] * len(slot_index)
+        for key, slot in slot_index.iteritems():
+            if key in self.vars_:
+                slots[slot] = self.vars_.pop(key)
+                assigned[slot] = True
+        self.slots = slots
+        self.assigned = assigned
+        self.slot_index = slot_index
+        return slots
+
+    def store_slots(self):
+        """Move the variables in slots back into `vars_`.
+
+        Slots that were never assigned to are left out, as they were never
+        variables to begin with.
+        """
+        for key, slot in self.slot_index.iteritems():
+            if self.assigned[slot]:
+                self.vars_[key] = self.slots[slot]
+        self.slots = []
+        self.assigned = []
+        self.slot_index = {}
+
+    def push_frame(self, args):
+        """Pass `args` to a function that's being called.
+
+        Arguments are passed in the variables -1, -2 and so on, with the
+        last argument in -1. When a function calls another, what its own
+        arguments were is kept until the call returns and `pop_frame` puts
+        them back, so that recursive calls don't clobber them. Calls made
+        from outside of any function leave their arguments set.
+        """
+        frames = self.frames
+        if len(frames) >= self.MAX_DEPTH:
+            raise StackOverflow(len(frames))
+        if frames:
+            saved = save_arguments(self.vars_, args)
+        else:
+            saved = None
+            vars_ = self.vars_
+            key = 0
+            for arg in reversed(args):
+                key -= 1
+                vars_[key] = arg
+        frames.append(saved)
+
+    def pop_frame(self):
+        """Put back the arguments of the function a call returns to."""
+        saved = self.frames.pop()
+        if saved:
+            restore_arguments(self.vars_, saved)
+
+    def call_cache(self, func, function):
+        """Return the CallCache for `function`, which was called by the key
+        `func`, or None if it isn't pure.
+
+        Functions of every engine have the keys of the arguments they read
+        as `reads` if they're pure, and None otherwise. Compiled functions
+        are made anew each time their definition runs, so they're cached by
+        their `source`, the FunctionBlock they were compiled from.
+        """
+        if function.reads is None:
+            return None
+        source = getattr(function, "source", function)
+        cache = self.call_caches.get(source)
+        if cache is None:
+            cache = self.call_caches[source] = CallCache(func,
+                                                         function.reads)
+        return cache
+
+    def close(self):
+        """Return the canvas to the pool it was borrowed from, if any."""
+        if self.pool is not None and self.canvas is not None:
+            self.pool.release(self.canvas)
+            self.canvas = None
 
     def _next_id(self):
         c = self.counter
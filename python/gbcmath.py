@@ -0,0 +1,62 @@
+"""The secant, cosecant and cotangent functions and their inverses.
+
+By default these work on floats with the `math` module. `use_mpmath()`
+switches them to mpmath's arbitrary-precision versions, whose results are
+`mpf`s that make all of the arithmetic done with them much slower.
+"""
+import math
+
+
+INFINITY = float("inf")
+
+# Either "float" or "mpmath", depending on which functions are in use.
+precision = "float"
+
+
+def reciprocal(x):
+    """Return 1 / x, or an infinity with the sign of `x` if it's zero."""
+    try:
+        return 1.0 / x
+    except ZeroDivisionError:
+        return math.copysign(INFINITY, x)
+
+
+def _sec(x):
+    return reciprocal(math.cos(x))
+
+def _csc(x):
+    return reciprocal(math.sin(x))
+
+def _cot(x):
+    return reciprocal(math.tan(x))
+
+def _asec(x):
+    return math.acos(reciprocal(x))
+
+def _acsc(x):
+    return math.asin(reciprocal(x))
+
+def _acot(x):
+    return math.atan(reciprocal(x))
+
+
+sec, csc, cot = _sec, _csc, _cot
+asec, acsc, acot = _asec, _acsc, _acot
+
+
+def use_mpmath(enabled=True):
+    """Use mpmath's functions if `enabled`, or the float ones otherwise.
+
+    This changes the functions for every program run afterwards, including
+    compiled ones.
+    """
+    global precision, sec, csc, cot, asec, acsc, acot
+    if enabled:
+        import mpmath
+        precision = "mpmath"
+        sec, csc, cot = mpmath.sec, mpmath.csc, mpmath.cot
+        asec, acsc, acot = mpmath.asec, mpmath.acsc, mpmath.acot
+    else:
+        precision = "float"
+        sec, csc, cot = _sec, _csc, _cot
+        asec, acsc, acot = _asec, _acsc, _acot
@@ -1,39 +1,306 @@
 import sys
+import time
+from contextlib import contextmanager
 
-from contexts import Context
-from operations import BreakInterrupt
+import gbcmath
+from contexts import Budget, Context
+from operations import resolve_slots, specialize, verify
 from parser import Parser, ParserError
+from vectorize import vectorize
 
+# PIL, the compiler, the caches and tracing are only imported once they're
+# used, so that checking a program doesn't wait on them.
 
-def main(f):
+
+ENGINES = ("tree", "compile", "vm")
+BACKENDS = ("pil", "numpy", "tiles")
+PHASES = ("load", "parse", "verify", "optimize", "compile", "run", "save")
+# How deeply Python may recurse once `allow_deep_calls` is called. The tree
+# engine takes a few Python frames for each call and for each block the
+# call is inside, so this lets it nest calls `Context.MAX_DEPTH` deep, while
+# staying well short of what overflows a worker's 8MB stack (about 20000
+# frames).
+RECURSION_LIMIT = 10000
+
+
+@contextmanager
+def phase(timings, name):
+    """Add the time spent in the block to `timings[name]`, if `timings` is
+    a dict."""
+    if timings is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0) + time.time() - start
+
+
+def allow_deep_calls():
+    """Let the engines that recurse on Python's stack nest calls as deep as
+    the VM does, by raising the recursion limit of the whole process.
+
+    Scripts and workers that run programs call this once as they start;
+    without it, deep recursion raises StackOverflow sooner in some engines.
+    """
+    if sys.getrecursionlimit() < RECURSION_LIMIT:
+        sys.setrecursionlimit(RECURSION_LIMIT)
+
+
+def main(f, **kwargs):
     with open(f) as file_:
-        return run(file_.read())
+        return run(file_.read(), **kwargs)
+
+def make_canvas(backend="pil", batched=False, **options):
+    """Make a canvas for `backend`, passing it `options`.
 
-def run(data):
-    p = Parser(data)
+    Every backend takes `scale` and `supersample`, and "tiles" also takes
+    `tile_size` and `workers`.
+    """
+    # NumPy is optional, so it is only imported when it is asked for.
+    if backend == "numpy":
+        from arraycanvas import ArrayCanvas
+        return ArrayCanvas(**options)
+    if backend == "tiles":
+        from tiles import TiledCanvas
+        return TiledCanvas(**options)
+    from canvas import Canvas
+    return Canvas(batched=batched, **options)
+
+def parse(data, optimize=True, tracer=None, timings=None):
+    """Parse and verify `data` and return its tree.
+
+    Raises ParserError, saying what's wrong and where, if `data` isn't a
+    valid program.
+    """
+    p = Parser(data, tracer=tracer)
     try:
-        block = p.run()
-    except BreakInterrupt:
-        print "Break called outside loop"
+        with phase(timings, "parse"):
+            block = p.run()
     except ParserError as e:
-        print "Block Stack:"
-        print "\n".join(map(repr, p.blocks))
-        print "\nExpressions:"
-        print "\n".join(map(repr, p.expressions))
-        print "\nBuffer: %s" % p.buffer
-        print "%s (at position %d)" % (e, p.position)
-        return
+        raise ParserError("%s (at position %d)" % (e, p.position))
 
-    print block
+    with phase(timings, "verify"):
+        errors = verify(block)
+    if errors:
+        raise ParserError("\n".join("%s (at position %d)" % (message,
+                                                             position)
+                                     for position, message in errors))
 
-    context = Context()
-    block.run(context)
+    if optimize:
+        with phase(timings, "optimize"):
+            block = vectorize(resolve_slots(specialize(block.optimize())))
+    return block
 
+def run(data, engine="tree", optimize=True, batched=False, backend="pil",
+        tracer=None, cache=None, budget=None, timings=None, pool=None,
+        canvas_options=None, vectorize=False):
+    """Run `data` and return its Context.
+
+    Raises ParserError if `data` isn't a valid program, as `parse` does.
+    If `timings` is a dict, the seconds spent in each of the `PHASES` are
+    added to it. If `pool` is a CanvasPool, the canvas is borrowed from it
+    rather than made, and should be given back by closing the context; the
+    pool has to make canvases for `backend` and `batched`. Otherwise the
+    canvas is made with `canvas_options`, as described in `make_canvas`.
+    If `vectorize` is true, the tree engine runs the loops it can with
+    NumPy, all of their iterations at once.
+    """
+    # Instrumenting a tree for tracing changes it, so traced runs always
+    # parse a fresh copy.
+    if cache is not None and tracer is None:
+        load = lambda source: parse(source, optimize)
+        with phase(timings, "load"):
+            if engine == "compile":
+                program = cache.program(data, optimize, load)
+            else:
+                block = cache.tree(data, optimize, load)
+                program = block.run
+        if engine == "vm":
+            from vm import lower
+            with phase(timings, "compile"):
+                program = lower(block)
+    else:
+        block = parse(data, optimize, tracer, timings)
+
+        if tracer:
+            from tracing import instrument
+            tracer("program", tree=block)
+            # Only the tree engine can report the operations it runs.
+            if engine == "tree":
+                instrument(block, tracer)
+
+        if engine == "compile":
+            from compiler import compile
+            with phase(timings, "compile"):
+                program = compile(block)
+        elif engine == "vm":
+            from vm import lower
+            with phase(timings, "compile"):
+                program = lower(block)
+        else:
+            program = block.run
+
+    if pool is not None:
+        context = Context(budget=budget, pool=pool, vectorize=vectorize)
+    else:
+        canvas = make_canvas(backend, batched, **(canvas_options or {}))
+        context = Context(canvas=canvas, budget=budget,
+                          vectorize=vectorize)
+    with phase(timings, "run"):
+        try:
+            program(context)
+        except Exception:
+            context.close()
+            raise
     return context
 
+def render(data, renders=None, backend="pil", compress_level=None,
+           **kwargs):
+    """Run `data` and return the PNG it draws.
+
+    If `renders` is a RenderCache, programs it has seen before aren't run
+    again, whatever compression level they were encoded with. The remaining
+    arguments are passed on to `run`.
+    """
+    def draw(source):
+        context = run(source, backend=backend, **kwargs)
+        try:
+            return context.canvas.to_bytes(compress_level=compress_level)
+        finally:
+            context.close()
+
+    if renders is None or kwargs.get("tracer"):
+        return draw(data)
+    from canvas import SIZE
+    options = sorted((kwargs.get("canvas_options") or {}).items())
+    return renders.render(data, draw, "%dx%d" % SIZE, backend,
+                          gbcmath.precision,
+                          *["%s=%s" % option for option in options])
+
 
 if __name__ == "__main__":
-    context = main(sys.argv[1])
-    output = sys.argv[2] if len(sys.argv) >= 3 else "/tmp/out.png"
-    context.canvas.save(output)
+    import argparse
+
+    cli = argparse.ArgumentParser(description="Run a GBC program.")
+    cli.add_argument("source", help="path to the program to run")
+    cli.add_argument("output", nargs="?", default="/tmp/out.png",
+                     help="where to save the rendered image")
+    cli.add_argument("--engine", choices=ENGINES, default="tree",
+                     help="walk the syntax tree, compile it to Python or "
+                          "run it as bytecode; compiling is the fastest, "
+                          "the others run at about the same speed")
+    cli.add_argument("--no-optimize", dest="optimize", action="store_false",
+                     help="run the program without optimizing it first")
+    cli.add_argument("--batch", dest="batched", action="store_true",
+                     help="record drawing operations and draw them in bulk")
+    cli.add_argument("--vectorize", action="store_true",
+                     help="run simple drawing loops all at once with NumPy")
+    cli.add_argument("--backend", choices=BACKENDS, default="pil",
+                     help="rasterize with PIL, into a NumPy array, or into "
+                          "NumPy arrays a tile at a time")
+    size = cli.add_argument_group("size")
+    size.add_argument("--scale", type=float, default=1,
+                      help="draw the image SCALE times larger")
+    size.add_argument("--supersample", type=int, default=1, metavar="N",
+                      help="antialias by drawing N times larger and "
+                           "shrinking the image")
+    size.add_argument("--tile-size", type=int, metavar="PIXELS",
+                      help="how large the tiles backend's tiles are")
+    size.add_argument("--workers", type=int, default=1, metavar="N",
+                      help="how many processes the tiles backend rasterizes "
+                           "tiles in")
+    cli.add_argument("--trace", action="append", metavar="EVENT",
+                     help="write EVENT events to stderr as JSON lines; may be "
+                          "repeated, and 'all' traces everything")
+    cli.add_argument("--cache", metavar="PATH",
+                     help="keep parsed programs in a cache saved at PATH")
+    cli.add_argument("--mpmath", action="store_true",
+                     help="compute sec, csc, cot and their inverses with "
+                          "mpmath's arbitrary precision")
+    cli.add_argument("--check", action="store_true",
+                     help="only parse and verify the program, exiting with "
+                          "status 1 if it has errors")
+    cli.add_argument("--time", action="store_true",
+                     help="write how long each phase took, and how often "
+                          "calls to pure functions were cached, to stderr")
+    limits = cli.add_argument_group("limits")
+    limits.add_argument("--max-steps", type=int, metavar="N",
+                        help="stop after N loop iterations and calls")
+    limits.add_argument("--max-seconds", type=float, metavar="N",
+                        help="stop after running for N seconds")
+    limits.add_argument("--max-variables", type=int, metavar="N",
+                        help="stop once more than N variables are set")
+    limits.add_argument("--max-depth", type=int, metavar="N",
+                        help="stop when calls are nested more than N deep")
+    args = cli.parse_args()
+
+    if args.mpmath:
+        gbcmath.use_mpmath()
+    allow_deep_calls()
+
+    timings = {} if args.time else None
+    with open(args.source) as file_:
+        data = file_.read()
+
+    if args.check:
+        try:
+            context = parse(data, optimize=False, timings=timings)
+        except ParserError as e:
+            print e
+            context = None
+    else:
+        tracer = None
+        if args.trace:
+            from tracing import StreamTracer
+            kinds = None if "all" in args.trace else args.trace
+            tracer = StreamTracer(sys.stderr, kinds=kinds)
+
+        cache = None
+        if args.cache:
+            from cache import ProgramCache
+            cache = ProgramCache(path=args.cache)
+        # Without limits, programs run without paying for a budget's checks.
+        budget = None
+        if (args.max_steps, args.max_seconds, args.max_variables,
+                args.max_depth) != (None, None, None, None):
+            budget = Budget(steps=args.max_steps, seconds=args.max_seconds,
+                            variables=args.max_variables,
+                            depth=args.max_depth)
+
+        canvas_options = {"scale": args.scale,
+                          "supersample": args.supersample}
+        if args.backend == "tiles":
+            if args.tile_size:
+                canvas_options["tile_size"] = args.tile_size
+            canvas_options["workers"] = args.workers
+        try:
+            context = run(data, engine=args.engine, optimize=args.optimize,
+                          batched=args.batched, backend=args.backend,
+                          tracer=tracer, cache=cache, budget=budget,
+                          timings=timings, canvas_options=canvas_options,
+                          vectorize=args.vectorize)
+        except ParserError as e:
+            print e
+            context = None
+        if cache is not None:
+            cache.save()
+        if context is not None:
+            with phase(timings, "save"):
+                context.canvas.save(args.output)
 
+    if timings is not None:
+        for name in PHASES:
+            if name in timings:
+                sys.stderr.write("%-9s %8.2fms\n" % (name,
+                                                    timings[name] * 1000))
+        if context is not None and not args.check:
+            caches = sorted(context.call_caches.values(),
+                            key=lambda cache: cache.func)
+            for cache in caches:
+                sys.stderr.write("calls to %s: %d hits, %d misses (%.1f%%)\n"
+                                 % (cache.func, cache.hits, cache.misses,
+                                    cache.hit_rate * 100))
+    if context is None:
+        sys.exit(1)
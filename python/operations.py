@@ -1,14 +1,22 @@
 import colorsys
+import copy
 import math
 from functools import wraps
 
-import mpmath
+import gbcmath
+from contexts import MISS, StackOverflow
 
 
 class BreakInterrupt(StandardError):
     pass
 
 
+# Returned by a `;`, and passed up by the blocks around it, to stop the loop
+# it's in. Only a break inside of a function is raised as `BreakInterrupt`,
+# since it has to unwind through the call's expression.
+BREAK = type("Break", (object,), {"__repr__": lambda self: "BREAK"})()
+
+
 OPERATIONS = {}
 def oper(name):
     def wrap(cls):
@@ -17,7 +25,66 @@ def oper(name):
     return wrap
 
 
+def walk(node):
+    """Yield `node` and every node beneath it."""
+    yield node
+    for child in node.children():
+        for n in walk(child):
+            yield n
+
+
+def is_constant(node):
+    return isinstance(node, (Literal, LiteralTuple))
+
+
+def freeze(block):
+    """Replace the lists of children that the parser built up with tuples,
+    which take less memory."""
+    for node in walk(block):
+        if isinstance(node, BlockOperation):
+            node.body = tuple(node.body)
+        elif isinstance(node, Continuation):
+            node.value = tuple(node.value)
+    return block
+
+
+def replace_calls(node, replace):
+    """Return `node` with every call beneath it replaced by `replace(call)`.
+
+    Only the nodes that have calls beneath them are copied, so the tree
+    `node` came from is left as it was.
+    """
+    if not any(isinstance(n, CallOperation) for n in walk(node)):
+        return node
+    node = copy.copy(node)
+    if isinstance(node, TrigInverterOperation):
+        # It maps the children of the function it wraps in place.
+        node.body = copy.copy(node.body)
+    node.map_children(lambda child: replace_calls(child, replace))
+    if isinstance(node, CallOperation):
+        return replace(node)
+    return node
+
+
+class Compact(type):
+    """Gives every class of operation empty `__slots__` unless it declares
+    its own, so that nodes don't each carry a `__dict__`. Large programs
+    have hundreds of thousands of them."""
+
+    def __new__(meta, name, bases, namespace):
+        namespace.setdefault("__slots__", ())
+        return super(Compact, meta).__new__(meta, name, bases, namespace)
+
+
 class Operation(object):
+    __metaclass__ = Compact
+    # Where the parser found the node, for error messages. Only operations
+    # that take a tuple are sure to have one.
+    __slots__ = ("position", )
+    # Whether the result depends only on the values of the node's children,
+    # which lets the optimizer fold it when they're all constant.
+    foldable = False
+
     def has_return_value(self):
         raise NotImplementedError()
 
@@ -27,6 +94,16 @@ class Operation(object):
     def run(self, context):
         pass
 
+    def children(self):
+        return []
+
+    def map_children(self, fn):
+        pass
+
+    def optimize(self):
+        self.map_children(lambda node: node.optimize())
+        return self
+
 
 class Statement(Operation):
     def has_return_value(self):
@@ -37,14 +114,44 @@ class Expression(Operation):
     def has_return_value(self):
         return True
 
+    def cheap_to_fold(self):
+        """Return whether the optimizer may work the expression out, which
+        happens before the program has a budget to stop it."""
+        return True
+
+    def optimize(self):
+        Operation.optimize(self)
+        if (self.foldable and all(map(is_constant, self.children())) and
+                self.cheap_to_fold()):
+            try:
+                value = self.run(None)
+            except Exception:
+                # Leave it to raise when the program reaches it.
+                return self
+            if not isinstance(value, tuple):
+                return Literal(value)
+        return self
+
 
 class PrefixOperation(Statement):
+    __slots__ = ("body", )
+    # The lengths of tuple the operation takes, if it takes one.
+    arity = None
+
     def __init__(self):
         self.body = None
+        self.position = None
 
     def push(self, node):
         self.body = node
 
+    def children(self):
+        return [self.body] if self.body is not None else []
+
+    def map_children(self, fn):
+        if self.body is not None:
+            self.body = fn(self.body)
+
 
 class PrefixStatement(PrefixOperation):
     def __repr__(self):
@@ -52,27 +159,17 @@ class PrefixStatement(PrefixOperation):
 
 
 class PrefixExpression(Expression, PrefixOperation):
+    foldable = True
+
     def __repr__(self):
         return "Expression(%s)>%s" % (self.name, self.body)
 
 
-def expect_continuation(len_=None):
-    def dec(f):
-        def wrap(self, context):
-            if not self.body:
-                raise Exception("Tuple not passed to prefix statement")
-            if not isinstance(self.body, Continuation):
-                raise Exception("Expected tuple, got non-tuple")
-
-            if len_ is not None:
-                length = (len_, ) if not isinstance(len_, tuple) else len_
-                if len(self.body.value) not in length:
-                    raise Exception("Tuple of invalid length (%s got %d)" %
-                                        (length, len(self.body.value)))
-
-            return f(self, context)
-        return wrap
-    return dec
+def hsl_to_rgb(h, s, l):
+    """Convert an HSL color with 0-255 components to an RGB tuple."""
+    h, s, l = map(lambda x: float(x) / 255, (h, s, l))
+    r, g, b = colorsys.hls_to_rgb(h, l, s)
+    return int(r * 255), int(g * 255), int(b * 255)
 
 
 @oper("n")
@@ -92,7 +189,7 @@ class NotOperation(PrefixExpression):
 @oper("&")
 class AndOperation(PrefixExpression):
     name = "And"
-    @expect_continuation(2)
+    arity = (2, )
     def run(self, context):
         left, right = self.body.value
         return 0 if left.run(context) == 0 else right.run(context)
@@ -101,7 +198,7 @@ class AndOperation(PrefixExpression):
 @oper("|")
 class OrOperation(PrefixExpression):
     name = "Or"
-    @expect_continuation(2)
+    arity = (2, )
     def run(self, context):
         left, right = self.body.value
         left = left.run(context)
@@ -111,7 +208,7 @@ class OrOperation(PrefixExpression):
 @oper("I")
 class IffOperation(PrefixExpression):
     name = "Iff"
-    @expect_continuation(3)
+    arity = (3, )
     def run(self, context):
         condition, left, right = self.body.value
         return left.run(context) if condition.run(context) else right.run(context)
@@ -120,7 +217,7 @@ class IffOperation(PrefixExpression):
 @oper("X")
 class XOROperation(PrefixExpression):
     name = "XOR"
-    @expect_continuation(2)
+    arity = (2, )
     def run(self, context):
         left, right = self.body.run(context)
         left, right = bool(left), bool(right)
@@ -152,21 +249,21 @@ class TanOperation(PrefixExpression):
 class SecOperation(PrefixExpression):
     name = "Sec"
     def run(self, context):
-        return mpmath.sec(self.body.run(context))
+        return gbcmath.sec(self.body.run(context))
 
 
 @oper("O")
 class CscOperation(PrefixExpression):
     name = "Csc"
     def run(self, context):
-        return mpmath.csc(self.body.run(context))
+        return gbcmath.csc(self.body.run(context))
 
 
 @oper("Y")
 class CotOperation(PrefixExpression):
     name = "Cot"
     def run(self, context):
-        return mpmath.cot(self.body.run(context))
+        return gbcmath.cot(self.body.run(context))
 
 
 @oper("!")
@@ -180,14 +277,32 @@ class TrigInverterOperation(PrefixExpression):
         if isinstance(self.body, TanOperation):
             return math.atan(self.body.body.run(context))
         if isinstance(self.body, SecOperation):
-            return mpmath.asec(self.body.body.run(context))
+            return gbcmath.asec(self.body.body.run(context))
         if isinstance(self.body, CscOperation):
-            return mpmath.acsc(self.body.body.run(context))
+            return gbcmath.acsc(self.body.body.run(context))
         if isinstance(self.body, CotOperation):
-            return mpmath.acot(self.body.body.run(context))
+            return gbcmath.acot(self.body.body.run(context))
 
         raise Exception("Unsupported inversion operation.")
 
+    def map_children(self, fn):
+        # The wrapped trig function only marks which inverse to use, so it
+        # has to stay in place; its argument is the real operand.
+        if isinstance(self.body, PrefixOperation):
+            self.body.map_children(fn)
+        else:
+            super(TrigInverterOperation, self).map_children(fn)
+
+    def optimize(self):
+        self.map_children(lambda node: node.optimize())
+        if (isinstance(self.body, PrefixOperation) and
+                all(map(is_constant, self.body.children()))):
+            try:
+                return Literal(self.run(None))
+            except Exception:
+                pass
+        return self
+
 
 @oper("_")
 class FloorOperation(PrefixExpression):
@@ -224,15 +339,25 @@ class SqRootOperation(PrefixExpression):
 @oper("a")
 class AssignOperation(PrefixExpression):
     name = "Assignment"
+    foldable = False
     def run(self, context):
         out = self.body.run(context)
+        # Keys computed at runtime may name a variable that lives in a slot.
         if isinstance(out, tuple):
             # An assignment
             id_, value = out
-            context.vars_[id_] = value
+            slot = context.slot_index.get(id_)
+            if slot is None:
+                context.vars_[id_] = value
+            else:
+                context.slots[slot] = value
+                context.assigned[slot] = True
             #print "%d = %s" % out
             return value
 
+        slot = context.slot_index.get(out)
+        if slot is not None:
+            return context.slots[slot]
         if out in context.vars_:
             return context.vars_[out]
         return 0
@@ -241,6 +366,7 @@ class AssignOperation(PrefixExpression):
 @oper("q")
 class CallOperation(PrefixExpression):
     name = "Call"
+    foldable = False
     def run(self, context):
         out = self.body.run(context)
         if isinstance(out, tuple):
@@ -249,21 +375,45 @@ class CallOperation(PrefixExpression):
             func, args = out, []
         if func not in context.funcs:
             raise Exception("Function `%d` not yet defined." % func)
+        function = context.funcs[func]
 
-        # Set up the arguments
-        args = enumerate(list(reversed(args)))
-        for idx, arg in args:
-            context.vars_[(idx + 1) * -1] = arg
-
-        out = 0
-        for op in context.funcs[func].body:
-            out = op.run(context)
+        context.push_frame(args)
+        try:
+            cache = None
+            if function.reads is not None:
+                cache = context.call_cache(func, function)
+                key, out = cache.lookup(context.vars_)
+                if out is not MISS:
+                    return out
+
+            budget = context.budget
+            if budget is not None:
+                budget.enter(context)
+            out = 0
+            try:
+                for op in function.body:
+                    out = op.run(context)
+                    if out is BREAK:
+                        raise BreakInterrupt()
+            finally:
+                if budget is not None:
+                    budget.leave()
+        except RuntimeError as e:
+            if "recursion" not in str(e):
+                raise
+            # Python's stack ran out before the context's depth limit.
+            raise StackOverflow(len(context.frames))
+        finally:
+            context.pop_frame()
         if out is None:
             out = 0
+        if cache is not None:
+            cache.store(key, out)
         return out
 
 
 class BlockOperation(Operation):
+    __slots__ = ("body", )
     name = "Unknown Block"
     def __init__(self):
         self.body = []
@@ -273,14 +423,50 @@ class BlockOperation(Operation):
 
     def run(self, context):
         for op in self.body:
-            op.run(context)
+            if op.run(context) is BREAK:
+                return BREAK
+
+    def children(self):
+        return list(self.body)
+
+    def map_children(self, fn):
+        self.body = tuple(fn(op) for op in self.body)
+
+    def optimize(self):
+        self.body = optimize_body(self.body)
+        return self
 
     def __repr__(self):
         return "block(%s){%s}" % (self.name,
                                   ",".join(map(repr, self.body)))
 
 
+def optimize_body(body, keep_tail=False):
+    """Optimize the operations of a block.
+
+    Operations that optimize to `None` are dead and are dropped, and plain
+    blocks left behind by constant conditionals are spliced into the body.
+    With `keep_tail`, the last operation keeps returning `None` so that a
+    function's return value is unchanged.
+    """
+    out = []
+    last = len(body) - 1
+    for index, op in enumerate(body):
+        op = op.optimize()
+        tail = keep_tail and index == last
+        if op is None:
+            if tail:
+                out.append(BlockOperation())
+            continue
+        if type(op) is BlockOperation and not tail:
+            out.extend(op.body)
+            continue
+        out.append(op)
+    return tuple(out)
+
+
 class BlockExpression(Expression):
+    __slots__ = ("body", )
     name = "Unknown Block Expression"
     def __init__(self):
         self.body = None
@@ -293,11 +479,19 @@ class BlockExpression(Expression):
             return self.body.run(context)
         return 0
 
+    def children(self):
+        return [self.body] if self.body is not None else []
+
+    def map_children(self, fn):
+        if self.body is not None:
+            self.body = fn(self.body)
+
     def __repr__(self):
         return "block(%s)<<{%s}" % (self.name, repr(self.body))
 
 
 class FirstExprBlockOperation(BlockOperation):
+    __slots__ = ("first", )
     def __init__(self):
         self.first = None
         self.body = []
@@ -308,6 +502,18 @@ class FirstExprBlockOperation(BlockOperation):
             return
         return super(FirstExprBlockOperation, self).push(operation)
 
+    def children(self):
+        return [self.first] + list(self.body)
+
+    def map_children(self, fn):
+        self.first = fn(self.first)
+        self.body = tuple(fn(op) for op in self.body)
+
+    def optimize(self):
+        self.first = self.first.optimize()
+        self.body = optimize_body(self.body)
+        return self
+
     def __repr__(self):
         return "block(%s)<%s>{%s}" % (self.name,
                                       repr(self.first),
@@ -316,21 +522,56 @@ class FirstExprBlockOperation(BlockOperation):
 
 @oper("L")
 class LoopBlock(FirstExprBlockOperation):
+    __slots__ = ("hoisted", )
     name = "Loop"
+    def __init__(self):
+        super(LoopBlock, self).__init__()
+        self.hoisted = ()
+
     def run(self, context):
         try:
-            for i in range(self.first.run(context)):
-                super(LoopBlock, self).run(context)
+            self.repeat(context, self.first.run(context))
         except BreakInterrupt:
             pass
 
+    def repeat(self, context, count):
+        """Run the body `count` times, or until it breaks."""
+        for h in self.hoisted:
+            h.reset()
+        budget = context.budget
+        run = super(LoopBlock, self).run
+        for i in xrange(count):
+            if budget is not None:
+                budget.step(context)
+            if run(context) is BREAK:
+                break
+
+    def optimize(self):
+        super(LoopBlock, self).optimize()
+        if (isinstance(self.first, Literal) and
+                isinstance(self.first.value, (int, long)) and
+                self.first.value <= 0):
+            return None
+        self.hoisted = hoist_invariants(self)
+        return self
+
 
 @oper("i")
 class ConditionalBlock(FirstExprBlockOperation):
     name = "Conditional"
     def run(self, context):
         if self.first.run(context) != 0:
-            super(ConditionalBlock, self).run(context)
+            return super(ConditionalBlock, self).run(context)
+
+    def optimize(self):
+        super(ConditionalBlock, self).optimize()
+        if not is_constant(self.first):
+            return self
+        if self.first.run(None) == 0:
+            return None
+        block = BlockOperation()
+        block.body = self.body
+        return block
 
 
 class ExecutableOperation(BlockOperation):
@@ -342,10 +583,23 @@ class ExecutableOperation(BlockOperation):
 
 @oper("{")
 class FunctionBlock(FirstExprBlockOperation, ExecutableOperation):
+    # The keys of the arguments the function reads, if it's pure, which
+    # lets calls to it be cached. Only the optimizer works it out.
+    __slots__ = ("reads", )
     name = "Function"
+    def __init__(self):
+        super(FunctionBlock, self).__init__()
+        self.reads = None
+
     def run(self, context):
         context.funcs[self.first.run(context)] = self
 
+    def optimize(self):
+        self.first = self.first.optimize()
+        self.body = optimize_body(self.body, keep_tail=True)
+        self.reads = pure_reads(self)
+        return self
+
 
 @oper("T")
 class AnyBlock(BlockOperation):
@@ -382,7 +636,7 @@ class NoParamStatement(Statement):
 @oper(";")
 class BreakStatement(NoParamStatement):
     def run(self, context):
-        raise BreakInterrupt()
+        return BREAK
 
 
 @oper("#")
@@ -412,7 +666,7 @@ class PathStatement(NoParamStatement):
 @oper("C")
 class RGBStatement(PrefixStatement):
     name = "RGBA"
-    @expect_continuation((3, 4))
+    arity = (3, 4)
     def run(self, context):
         body = self.body.run(context)
         mode = "rgba" if len(body) == 4 else "rgb"
@@ -422,21 +676,18 @@ class RGBStatement(PrefixStatement):
 @oper("H")
 class HSLStatement(PrefixStatement):
     name = "HSLA"
-    @expect_continuation((3, 4))
+    arity = (3, 4)
     def run(self, context):
         values = self.body.run(context)
         a = 255 if len(values) == 3 else values[3]
-        print values[:3]
-        h, s, l = map(lambda x: float(x) / 255, values[:3])
-        r, g, b = colorsys.hls_to_rgb(h, l, s)
-        r, g, b = int(r * 255), int(g * 255), int(b * 255)
+        r, g, b = hsl_to_rgb(*values[:3])
         context.canvas.set_color(r, g, b, mode="rgb")
 
 
 @oper("p")
 class CursorStatement(PrefixStatement):
     name = "Cursor"
-    @expect_continuation(2)
+    arity = (2, )
     def run(self, context):
         context.canvas.set_cursor(*self.body.run(context))
 
@@ -444,7 +695,7 @@ class CursorStatement(PrefixStatement):
 @oper("t")
 class TranslateStatement(PrefixStatement):
     name = "Translate"
-    @expect_continuation(2)
+    arity = (2, )
     def run(self, context):
         context.canvas.translate(*self.body.run(context))
 
@@ -464,7 +715,10 @@ class ScaleStatement(PrefixStatement):
 
 
 class InfixOperation(Expression):
+    __slots__ = ("left", "right")
     name = "Generic Infix Operation"
+    foldable = True
+
     def __init__(self, left):
         self.left = left
         self.right = None
@@ -472,6 +726,12 @@ class InfixOperation(Expression):
     def push(self, operation):
         self.right = operation
 
+    def children(self):
+        return [self.left, self.right]
+
+    def map_children(self, fn):
+        self.left, self.right = fn(self.left), fn(self.right)
+
     def run(self, context):
         left, right = self.left.run(context), self.right.run(context)
         return self._run(left, right)
@@ -512,9 +772,24 @@ class ModOperation(InfixOperation):
 
 @oper("^")
 class PowOperation(InfixOperation):
+    # The most bits a power of integers may have for the optimizer to work
+    # it out; bigger ones take long enough to be left to the program.
+    MAX_FOLD_BITS = 1 << 16
+
     def _run(self, left, right):
         return left ** right
 
+    def cheap_to_fold(self):
+        if not (isinstance(self.left, Literal) and
+                isinstance(self.right, Literal)):
+            return True
+        base, exponent = self.left.value, self.right.value
+        if not (isinstance(base, (int, long)) and
+                isinstance(exponent, (int, long))):
+            return True
+        return (exponent <= 0 or abs(base) < 2 or
+                base.bit_length() * exponent <= self.MAX_FOLD_BITS)
+
 
 @oper(">")
 class GTOperation(InfixOperation):
@@ -529,7 +804,7 @@ class GTEOperation(InfixOperation):
 
 
 @oper("=")
-class GTOperation(InfixOperation):
+class EqualOperation(InfixOperation):
     def _run(self, left, right):
         return left == right
 
@@ -542,6 +817,9 @@ class DNEOperation(InfixOperation):
 
 @oper(",")
 class Continuation(InfixOperation):
+    __slots__ = ("value", )
+    foldable = False
+
     def __init__(self, left):
         if isinstance(left, Continuation):
             self.value = left.value
@@ -557,20 +835,454 @@ class Continuation(InfixOperation):
     def run(self, context):
         return tuple(v.run(context) for v in self.value)
 
+    def children(self):
+        return list(self.value)
+
+    def map_children(self, fn):
+        self.value = tuple(fn(v) for v in self.value)
+
+    def optimize(self):
+        self.map_children(lambda node: node.optimize())
+        if all(isinstance(v, Literal) for v in self.value):
+            return LiteralTuple(self.value)
+        return self
+
     def __repr__(self):
         return "[%s]" % ",".join(map(repr, self.value))
 
 
+class LiteralTuple(Continuation):
+    """A tuple of literals, built once by the optimizer."""
+    __slots__ = ("constant", )
+    def __init__(self, values):
+        self.value = tuple(values)
+        self.constant = tuple(v.value for v in self.value)
+
+    def run(self, context):
+        return self.constant
+
+    def optimize(self):
+        return self
+
+
+class HoistedExpression(Expression):
+    """A loop-invariant expression, evaluated at most once each time its
+    loop runs.
+
+    The value is worked out the first time the expression is reached, so
+    one in a branch that's never taken is never evaluated, and errors are
+    raised where the program would have raised them. `reset` forgets it
+    when the loop starts again.
+    """
+    __slots__ = ("expr", "value", "ready")
+    name = "Hoisted"
+    def __init__(self, expr):
+        self.expr = expr
+        self.value = None
+        self.ready = False
+
+    def reset(self):
+        self.ready = False
+
+    def run(self, context):
+        if not self.ready:
+            self.value = self.expr.run(context)
+            self.ready = True
+        return self.value
+
+    def children(self):
+        return [self.expr]
+
+    def map_children(self, fn):
+        self.expr = fn(self.expr)
+
+    def optimize(self):
+        return self
+
+    def __repr__(self):
+        return "hoisted(%r)" % self.expr
+
+
+def _loop_writes(loop):
+    """Return the variables written by a loop's body, or `None` if unknown."""
+    written = set()
+    nodes = list(loop.body)
+    while nodes:
+        node = nodes.pop()
+        if isinstance(node, CallOperation):
+            return None
+        if isinstance(node, FunctionBlock):
+            # Defining a function doesn't run its body.
+            nodes.append(node.first)
+            continue
+        if (isinstance(node, AssignOperation) and
+                isinstance(node.body, Continuation)):
+            key = node.body.value[0]
+            if not isinstance(key, Literal):
+                return None
+            written.add(key.value)
+        nodes.extend(node.children())
+    return written
+
+
+def _invariant(node, written):
+    if isinstance(node, Literal):
+        return True
+    if isinstance(node, AssignOperation):
+        if written is None or isinstance(node.body, Continuation):
+            return False
+        if isinstance(node.body, Literal):
+            return node.body.value not in written
+        return not written and _invariant(node.body, written)
+    if not (node.foldable or isinstance(node, Continuation)):
+        return False
+    return all(_invariant(n, written) for n in node.children())
+
+
+def hoist_invariants(loop):
+    """Replace the loop-invariant expressions in a loop's body with
+    `HoistedExpression`s and return them."""
+    written = _loop_writes(loop)
+    hoisted = []
+
+    def hoist(node):
+        if isinstance(node, (FunctionBlock, HoistedExpression)):
+            return node
+        if node.foldable and _invariant(node, written):
+            h = HoistedExpression(node)
+            hoisted.append(h)
+            return h
+        node.map_children(hoist)
+        return node
+
+    loop.body = tuple(hoist(op) for op in loop.body)
+    return hoisted
+
+
+def pure_reads(function):
+    """Return the keys of the arguments a function reads if it's pure, or
+    None if it isn't.
+
+    A pure function's result depends only on its arguments: it doesn't
+    draw, assign, call, define functions or break, and the only variables
+    it reads are the ones with literal negative keys that calls pass
+    arguments in.
+    """
+    reads = set()
+    nodes = list(function.body)
+    while nodes:
+        node = nodes.pop()
+        if isinstance(node, AssignOperation):
+            if not (isinstance(node.body, Literal) and node.body.value < 0):
+                return None
+            reads.add(node.body.value)
+            continue
+        if not (isinstance(node, (Literal, Continuation, HoistedExpression,
+                                  LoopBlock, ConditionalBlock, AnyBlock,
+                                  AllBlock, SumBlock)) or
+                type(node) is BlockOperation or
+                isinstance(node, Expression) and node.foldable):
+            return None
+        nodes.extend(node.children())
+    return tuple(sorted(reads))
+
+
+def verify(block):
+    """Check the tuples passed to every operation that takes one.
+
+    Returns a list of (position, message) pairs, one for each malformed
+    operation, which is empty if the program is well formed.
+    """
+    errors = []
+    for node in walk(block):
+        if not isinstance(node, PrefixOperation) or node.arity is None:
+            continue
+        if node.body is None:
+            message = "Tuple not passed to prefix statement"
+        elif not isinstance(node.body, Continuation):
+            message = "Expected tuple, got non-tuple"
+        elif len(node.body.value) not in node.arity:
+            message = "Tuple of invalid length (%s got %d)" % (
+                node.arity, len(node.body.value))
+        else:
+            continue
+        errors.append((node.position, "%s: %s" % (node.name, message)))
+    return errors
+
+
+class SpecializedOperation(Operation):
+    """An operation whose tuple has been verified and unpacked into the
+    attributes named by `fields`, so running it builds no tuple.
+
+    `generic` is the class of operation it replaces.
+    """
+    generic = None
+    fields = ()
+
+    def __init__(self, node):
+        for field, value in zip(self.fields, node.body.value):
+            setattr(self, field, value)
+        self.position = node.position
+
+    def children(self):
+        return [getattr(self, field) for field in self.fields]
+
+    def map_children(self, fn):
+        for field in self.fields:
+            setattr(self, field, fn(getattr(self, field)))
+
+    def __repr__(self):
+        return "%s%d(%s)" % (self.name, len(self.fields),
+                             ",".join(map(repr, self.children())))
+
+
+class AndOperation2(SpecializedOperation, Expression):
+    name = "And"
+    generic = AndOperation
+    fields = __slots__ = ("left", "right")
+    foldable = True
+    def run(self, context):
+        if self.left.run(context) == 0:
+            return 0
+        return self.right.run(context)
+
+
+class OrOperation2(SpecializedOperation, Expression):
+    name = "Or"
+    generic = OrOperation
+    fields = __slots__ = ("left", "right")
+    foldable = True
+    def run(self, context):
+        left = self.left.run(context)
+        return left if left != 0 else self.right.run(context)
+
+
+class IffOperation3(SpecializedOperation, Expression):
+    name = "Iff"
+    generic = IffOperation
+    fields = __slots__ = ("condition", "left", "right")
+    foldable = True
+    def run(self, context):
+        if self.condition.run(context):
+            return self.left.run(context)
+        return self.right.run(context)
+
+
+class XOROperation2(SpecializedOperation, Expression):
+    name = "XOR"
+    generic = XOROperation
+    fields = __slots__ = ("left", "right")
+    foldable = True
+    def run(self, context):
+        left = bool(self.left.run(context))
+        return left != bool(self.right.run(context))
+
+
+class RGBStatement3(SpecializedOperation, Statement):
+    name = "RGBA"
+    generic = RGBStatement
+    fields = __slots__ = ("r", "g", "b")
+    def run(self, context):
+        context.canvas.set_color(self.r.run(context), self.g.run(context),
+                                 self.b.run(context), mode="rgb")
+
+
+class RGBStatement4(SpecializedOperation, Statement):
+    name = "RGBA"
+    generic = RGBStatement
+    fields = __slots__ = ("r", "g", "b", "a")
+    def run(self, context):
+        context.canvas.set_color(self.r.run(context), self.g.run(context),
+                                 self.b.run(context), self.a.run(context),
+                                 mode="rgba")
+
+
+class HSLStatement3(SpecializedOperation, Statement):
+    name = "HSLA"
+    generic = HSLStatement
+    fields = __slots__ = ("h", "s", "l")
+    def run(self, context):
+        r, g, b = hsl_to_rgb(self.h.run(context), self.s.run(context),
+                             self.l.run(context))
+        context.canvas.set_color(r, g, b, mode="rgb")
+
+
+class HSLStatement4(HSLStatement3):
+    __slots__ = ("a", )
+    fields = ("h", "s", "l", "a")
+    def run(self, context):
+        h, s, l = (self.h.run(context), self.s.run(context),
+                   self.l.run(context))
+        # The alpha is still evaluated, but HSL colors are always opaque.
+        self.a.run(context)
+        context.canvas.set_color(*hsl_to_rgb(h, s, l), mode="rgb")
+
+
+class CursorStatement2(SpecializedOperation, Statement):
+    name = "Cursor"
+    generic = CursorStatement
+    fields = __slots__ = ("x", "y")
+    def run(self, context):
+        context.canvas.set_cursor(self.x.run(context), self.y.run(context))
+
+
+class TranslateStatement2(SpecializedOperation, Statement):
+    name = "Translate"
+    generic = TranslateStatement
+    fields = __slots__ = ("x", "y")
+    def run(self, context):
+        context.canvas.translate(self.x.run(context), self.y.run(context))
+
+
+# Maps each operation that takes a tuple to its specialized classes, by the
+# length of the tuple.
+SPECIALIZED = {}
+for cls in [AndOperation2, OrOperation2, IffOperation3, XOROperation2,
+            RGBStatement3, RGBStatement4, HSLStatement3, HSLStatement4,
+            CursorStatement2, TranslateStatement2]:
+    SPECIALIZED.setdefault(cls.generic, {})[len(cls.fields)] = cls
+del cls
+
+
+def specialize(block):
+    """Replace the operations that take a tuple with their specialized
+    versions. The tree must have been verified first."""
+    def rewrite(node):
+        node.map_children(rewrite)
+        lengths = SPECIALIZED.get(type(node))
+        if lengths is None:
+            return node
+        return lengths[len(node.body.value)](node)
+
+    block.map_children(rewrite)
+    return block
+
+
+def tuple_values(node, *lengths):
+    """Return the members of a Continuation body of an accepted length."""
+    if isinstance(node, Continuation) and len(node.value) in lengths:
+        return node.value
+    return None
+
+
+def tuple_arguments(node, cls, *lengths):
+    """Return the members of the tuple passed to `node` if it's a `cls`,
+    specialized or not, and the tuple is of an accepted length."""
+    if isinstance(node, SpecializedOperation):
+        if node.generic is cls and len(node.fields) in lengths:
+            return node.children()
+        return None
+    if isinstance(node, cls):
+        return tuple_values(node.body, *lengths)
+    return None
+
+
+class SlotRead(Expression):
+    """Reads the variable with a literal key from its slot."""
+    __slots__ = ("key", "index")
+    name = "Slot"
+    def __init__(self, key, index):
+        self.key = key
+        self.index = index
+
+    def run(self, context):
+        return context.slots[self.index]
+
+    def __repr__(self):
+        return "Slot(%s)" % self.key
+
+
+class SlotWrite(Expression):
+    """Assigns to the variable with a literal key in its slot."""
+    __slots__ = ("key", "index", "value")
+    name = "Slot Assignment"
+    def __init__(self, key, index, value):
+        self.key = key
+        self.index = index
+        self.value = value
+
+    def run(self, context):
+        value = self.value.run(context)
+        context.slots[self.index] = value
+        context.assigned[self.index] = True
+        return value
+
+    def children(self):
+        return [self.value]
+
+    def map_children(self, fn):
+        self.value = fn(self.value)
+
+    def __repr__(self):
+        return "Slot(%s)<-%s" % (self.key, self.value)
+
+
+class SlottedBlock(BlockOperation):
+    """The root of a program whose literal-keyed variables live in slots.
+
+    `slots` maps each key to its slot. The variables are moved out of
+    `context.vars_` while the program runs and put back when it finishes.
+    """
+    __slots__ = ("slots", )
+    name = "Slotted"
+    def __init__(self, body, slots):
+        self.body = body
+        self.slots = slots
+
+    def run(self, context):
+        context.use_slots(self.slots)
+        try:
+            return super(SlottedBlock, self).run(context)
+        finally:
+            context.store_slots()
+
+
+def resolve_slots(block):
+    """Give every variable read or assigned with a literal, non-negative key
+    a slot, and return the program as a `SlottedBlock` if any were found.
+
+    Negative keys are left alone since calls pass arguments through them.
+    This has to come after the optimizer, which only knows about variables
+    that are accessed with `AssignOperation`s.
+    """
+    slots = {}
+
+    def slot(key):
+        if key not in slots:
+            slots[key] = len(slots)
+        return slots[key]
+
+    def resolve(node):
+        if isinstance(node, AssignOperation):
+            body = node.body
+            if isinstance(body, Literal) and body.value >= 0:
+                return SlotRead(body.value, slot(body.value))
+            if (isinstance(body, Continuation) and len(body.value) == 2 and
+                    isinstance(body.value[0], Literal) and
+                    body.value[0].value >= 0):
+                key = body.value[0].value
+                return SlotWrite(key, slot(key), resolve(body.value[1]))
+        node.map_children(resolve)
+        return node
+
+    block.map_children(resolve)
+    if not slots:
+        return block
+    return SlottedBlock(block.body, slots)
+
+
 class Literal(Operation):
+    __slots__ = ("value", )
     def __init__(self, value):
-        if "." in value:
-            value = float(value)
-        else:
-            value = int(value)
+        if isinstance(value, basestring):
+            if "." in value:
+                value = float(value)
+            else:
+                value = int(value)
         self.value = value
 
     def run(self, context):
         return self.value
 
     def __repr__(self):
-        return "[%d]" % self.value
+        return "[%s]" % self.value
@@ -1,3 +1,5 @@
+import re
+
 from operations import *
 
 
@@ -10,10 +12,21 @@ PREFIX_STATEMENTS = "CHptrS"
 PREFIX_EXPRESSIONS = "nN&|IXsoTEOY_`\"!\\aq"
 INFIX_EXPRESSIONS = "+-*/^%M>g=x"
 CONTINUATION = ","
+BREAK = ";"
 WHITESPACE = " \n\r\t"
 
 STATEMENTS = SINGLE_OPERATIONS + PREFIX_STATEMENTS
 
+# Numbers and runs of whitespace are single tokens, and every other character
+# is a token of its own.
+TOKEN = re.compile(r"[%s]+|[%s]+|." % (re.escape(NUMBERS),
+                                       re.escape(WHITESPACE)), re.DOTALL)
+
+
+def tokenize(data):
+    """Split GBC source into a list of tokens."""
+    return TOKEN.findall(data)
+
 
 class ParserError(Exception):
     pass
@@ -21,20 +34,37 @@ class ParserError(Exception):
 
 class Parser(object):
 
-    def __init__(self, data):
+    def __init__(self, data, tracer=None):
         self.data = data
+        self.trace = tracer
         self.buffer = ""
         self.blocks = [BlockOperation()]
         self.expressions = []
         self.position = 0
+        # Literals are never changed once they're parsed, so every use of
+        # the same number shares one.
+        self.literals = {}
+
+    def make(self, char):
+        node = OPERATIONS[char]()
+        node.position = self.position
+        return node
+
+    def literal(self, text):
+        node = self.literals.get(text)
+        if node is None:
+            node = self.literals[text] = Literal(text)
+        return node
 
     def push_block(self, block):
-        print "Pushing block"
+        if self.trace:
+            self.trace("push_block", block=block.name)
         self.blocks.append(block)
 
     def pop_block(self):
-        print "Popping block"
         block = self.blocks.pop()
+        if self.trace:
+            self.trace("pop_block", block=block.name)
         if self.expressions:
             block.push(self.collapse_expressions())
         self.blocks[-1].push(block)
@@ -58,7 +88,8 @@ class Parser(object):
 
     def collapse_expressions(self, offset=0):
         e = None
-        print "Collapsing expressions"
+        if self.trace:
+            self.trace("collapse", depth=len(self.expressions) - offset)
         while self.expressions[offset:]:
             e = self.expressions.pop()
             if self.expressions:
@@ -66,112 +97,27 @@ class Parser(object):
         return e
 
     def run(self):
-        for char in self.data:
-            self.position += 1
-            if char not in NUMBERS and self.buffer:
-                value = "".join(self.buffer)
-                print "Flushing buffer: %s" % value
-                self.push_to_tip(Literal(value))
+        trace = self.trace
+        dispatch, read_number = DISPATCH, READ_NUMBER
+        offset = 0
+        for token in tokenize(self.data):
+            if trace:
+                trace("token", text=token, offset=offset)
+            # `position` counts the characters read so far, including the
+            # first one of this token.
+            self.position = offset + 1
+            offset += len(token)
+
+            handler = dispatch.get(token[0])
+            if self.buffer and handler is not read_number:
+                value = self.buffer
+                if trace:
+                    trace("literal", value=value)
+                self.push_to_tip(self.literal(value))
                 self.buffer = ""
-            elif char in NUMBERS:
-                # Don't accept numbers like `10.23.4`
-                if char == "." and "." in self.buffer:
-                    raise ParserError("Invalid numeric literal.")
-                self.buffer += char
-                continue
 
-            if char == CONTINUATION:
-                if not self.expressions:
-                    raise ParserError("Continuation inside block")
-                print "Popping expression for continuation"
-                e = self.expressions.pop()
-                if not (issubclass(type(e), Literal) or
-                        issubclass(type(e), Expression)):
-                    raise ParserError("Continuation against non-expressive "
-                                      "value (%s)." % e)
-                c = Continuation(e)
-                self.push_to_tip(c)
-                continue
-
-            if char == BLOCK_END:
-                # If we find the end of a block expression, just deal with it
-                # and move along.
-                found = False
-                for index, value in reversed(list(enumerate(self.expressions))):
-                    if not isinstance(value, BlockExpression):
-                        continue
-                    self.push_to_tip(self.collapse_expressions(index))
-                    found = True
-                    break
-                if found:
-                    continue
-
-                # Test that there's a block on the block stack to close.
-                if not any(issubclass(type(b), BlockOperation) for
-                           b in self.blocks):
-                    raise ParserError("End of block detected outside of block")
-
-                if self.expressions:
-                    self.push_to_block(self.collapse_expressions())
-
-                # Keep popping until we've popped a block.
-                p = self.pop_block()
-                while not issubclass(type(p), BlockOperation):
-                    p = self.pop_block()
-                continue
-
-            if char in WHITESPACE:
-                if self.expressions:
-                    print "Dealing with whitespace in an expression"
-                    e = self.expressions.pop()
-                    print "  ", e
-                    if isinstance(e, Continuation):
-                        print "  Continuation"
-                        self.expressions[-1].push(e)
-                        e = self.expressions.pop()
-
-                    if self.expressions:
-                        print "  Pushing to expression", self.expressions[-1]
-                        last_exp = self.expressions[-1]
-                        last_exp.push(e)
-                        try:
-                            next_last = self.expressions[-2]
-                            if isinstance(next_last, Continuation):
-                                next_last.push(self.expressions.pop())
-                        except IndexError:
-                            pass
-                    else:
-                        print "  Pushing to block"
-                        self.push_to_block(e)
-                continue
-
-            if char in STATEMENTS:
-                if self.expressions:
-                    self.push_to_block(self.collapse_expressions())
-                print "Pushing %s to tip" % char
-                self.push_to_tip(OPERATIONS[char]())
-            elif char in PREFIX_EXPRESSIONS:
-                print "Prefix expression", char
-                self.push_to_tip(OPERATIONS[char]())
-            elif char in INFIX_EXPRESSIONS:
-                print "Infix expression", char
-                if not self.expressions:
-                    raise ParserError("Infix operation in invalid location.")
-                e = self.expressions.pop()
-                if isinstance(e, Continuation):
-                    last = e.value.pop()
-                    self.expressions.append(e)
-                    self.push_to_tip(OPERATIONS[char](last))
-                else:
-                    self.push_to_tip(OPERATIONS[char](e))
-            elif char in BLOCK_STATEMENTS:
-                print "Block Statement", char
-                if self.expressions:
-                    self.push_to_block(self.collapse_expressions())
-                self.push_block(OPERATIONS[char]())
-            elif char in BLOCK_EXPRESSIONS:
-                print "Block expression", char
-                self.push_to_tip(OPERATIONS[char]())
+            if handler is not None:
+                handler(self, token)
 
         if self.expressions:
             raise ParserError("Expressions remaining on the stack at termination.")
@@ -180,4 +126,127 @@ class Parser(object):
         if self.blocks:
             raise ParserError("Unclosed blocks detected at end of program.")
 
-        return body
+        return freeze(body)
+
+    def read_number(self, token):
+        # Don't accept numbers like `10.23.4`
+        if token.count(".") > 1:
+            second = token.index(".", token.index(".") + 1)
+            self.position += second
+            self.buffer = token[:second]
+            raise ParserError("Invalid numeric literal.")
+        self.position += len(token) - 1
+        self.buffer = token
+
+    def read_continuation(self, char):
+        if not self.expressions:
+            raise ParserError("Continuation inside block")
+        e = self.expressions.pop()
+        if not (issubclass(type(e), Literal) or
+                issubclass(type(e), Expression)):
+            raise ParserError("Continuation against non-expressive "
+                              "value (%s)." % e)
+        c = Continuation(e)
+        self.push_to_tip(c)
+
+    def read_block_end(self, char):
+        # If we find the end of a block expression, just deal with it and
+        # move along.
+        for index, value in reversed(list(enumerate(self.expressions))):
+            if not isinstance(value, BlockExpression):
+                continue
+            self.push_to_tip(self.collapse_expressions(index))
+            return
+
+        # Test that there's a block on the block stack to close.
+        if not any(issubclass(type(b), BlockOperation) for b in self.blocks):
+            raise ParserError("End of block detected outside of block")
+
+        if self.expressions:
+            self.push_to_block(self.collapse_expressions())
+
+        # Keep popping until we've popped a block.
+        p = self.pop_block()
+        while not issubclass(type(p), BlockOperation):
+            p = self.pop_block()
+
+    def read_whitespace(self, token):
+        # Every character of whitespace closes off another expression, until
+        # there are none left.
+        end = self.position + len(token) - 1
+        self.position -= 1
+        for char in token:
+            if not self.expressions:
+                break
+            self.position += 1
+            e = self.expressions.pop()
+            if isinstance(e, Continuation):
+                self.expressions[-1].push(e)
+                e = self.expressions.pop()
+
+            if self.expressions:
+                last_exp = self.expressions[-1]
+                last_exp.push(e)
+                try:
+                    next_last = self.expressions[-2]
+                    if isinstance(next_last, Continuation):
+                        next_last.push(self.expressions.pop())
+                except IndexError:
+                    pass
+            else:
+                self.push_to_block(e)
+        self.position = end
+
+    def read_statement(self, char):
+        if self.expressions:
+            self.push_to_block(self.collapse_expressions())
+        self.push_to_tip(self.make(char))
+
+    def read_break(self, char):
+        # A break inside of a function stops the loop the function is called
+        # from, so only one that's in neither can be rejected here.
+        if not any(isinstance(b, (LoopBlock, FunctionBlock))
+                   for b in self.blocks):
+            raise ParserError("Break called outside loop")
+        self.read_statement(char)
+
+    def read_prefix_expression(self, char):
+        self.push_to_tip(self.make(char))
+
+    def read_infix_expression(self, char):
+        if not self.expressions:
+            raise ParserError("Infix operation in invalid location.")
+        e = self.expressions.pop()
+        if isinstance(e, Continuation):
+            last = e.value.pop()
+            self.expressions.append(e)
+            self.push_to_tip(OPERATIONS[char](last))
+        else:
+            self.push_to_tip(OPERATIONS[char](e))
+
+    def read_block_statement(self, char):
+        if self.expressions:
+            self.push_to_block(self.collapse_expressions())
+        self.push_block(OPERATIONS[char]())
+
+    def read_block_expression(self, char):
+        self.push_to_tip(OPERATIONS[char]())
+
+
+# Maps the first character of a token to the method that reads it. Where a
+# character belongs to more than one class, the earlier entry wins.
+DISPATCH = {}
+for chars, handler in reversed([
+        (NUMBERS, Parser.read_number),
+        (CONTINUATION, Parser.read_continuation),
+        (BLOCK_END, Parser.read_block_end),
+        (WHITESPACE, Parser.read_whitespace),
+        (BREAK, Parser.read_break),
+        (STATEMENTS, Parser.read_statement),
+        (PREFIX_EXPRESSIONS, Parser.read_prefix_expression),
+        (INFIX_EXPRESSIONS, Parser.read_infix_expression),
+        (BLOCK_STATEMENTS, Parser.read_block_statement),
+        (BLOCK_EXPRESSIONS, Parser.read_block_expression)]):
+    DISPATCH.update(dict.fromkeys(chars, handler))
+del chars, handler
+READ_NUMBER = DISPATCH[NUMBERS[0]]
@@ -0,0 +1,152 @@
+import os
+import signal
+import threading
+from collections import namedtuple
+from multiprocessing import Pool
+from multiprocessing.util import Finalize
+from Queue import Full, Queue
+
+from cache import ProgramCache, RenderCache
+from canvas import CanvasPool
+from contexts import Budget
+from interpreter import allow_deep_calls, render
+
+
+Job = namedtuple("Job", "source user")
+
+# The budget every job gets by default, beyond the pipeline's timeout.
+LIMITS = {"steps": 1000000, "variables": 100000, "depth": 64}
+
+
+class JobTimeout(Exception):
+    pass
+
+
+class Poster(object):
+    """Publishes the images rendered by a pipeline."""
+
+    def post(self, job, png):
+        raise NotImplementedError()
+
+    def error(self, job, message):
+        print "Job for %s failed: %s" % (job.user, message)
+
+
+class DirectoryPoster(Poster):
+    """Writes every image to a directory instead of publishing it."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.count = 0
+
+    def post(self, job, png):
+        self.count += 1
+        name = "%d-%s.png" % (self.count, job.user)
+        with open(os.path.join(self.directory, name), "wb") as file_:
+            file_.write(png)
+
+
+# Each worker process keeps its own caches and canvases, set up by
+# `_start_worker`.
+_programs = None
+_renders = None
+_canvases = None
+
+def _start_worker(program_cache, render_cache):
+    global _programs, _renders, _canvases
+    # Ctrl-C is handled by the parent, which shuts the workers down itself.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    allow_deep_calls()
+    _programs = ProgramCache(path=program_cache)
+    # Trees are saved in batches, so the last one is saved as the worker
+    # exits once the pool is closed.
+    Finalize(_programs, _programs.save, exitpriority=10)
+    _renders = RenderCache(directory=render_cache)
+    _canvases = CanvasPool()
+
+def _on_alarm(signum, frame):
+    raise JobTimeout("Program took too long to run")
+
+def _run_job(source, timeout, limits, compress_level):
+    """Render `source` in a worker, returning a (png, error) pair."""
+    # The budget's deadline stops programs cleanly between steps, and the
+    # alarm catches any single operation that runs on past it.
+    signal.signal(signal.SIGALRM, _on_alarm)
+    signal.alarm(timeout + 1)
+    try:
+        budget = Budget(seconds=timeout, **limits)
+        png = render(source, renders=_renders, cache=_programs,
+                     budget=budget, compress_level=compress_level,
+                     pool=_canvases)
+        return png, None
+    except Exception as e:
+        return None, str(e) or type(e).__name__
+    finally:
+        signal.alarm(0)
+
+
+class Pipeline(object):
+    """Renders jobs in a pool of worker processes and posts the results.
+
+    `submit` only queues a job. Up to `max_pending` jobs may be queued or
+    running at once, after which `submit` blocks until one finishes. Each
+    job may run for `timeout` seconds, and within the other `limits` of its
+    budget, before it's abandoned. Finished jobs are handed to `poster` on an
+    uploader thread, in the order they finish. Lowering `compress_level`
+    trades larger uploads for less time spent encoding PNGs.
+    """
+
+    def __init__(self, poster, workers=None, max_pending=32, timeout=30,
+                 limits=LIMITS, compress_level=None, program_cache=None,
+                 render_cache=None):
+        self.poster = poster
+        self.timeout = timeout
+        self.limits = limits
+        self.compress_level = compress_level
+        # Holds an entry for every job that hasn't been posted yet.
+        self.pending = Queue(max_pending)
+        self.results = Queue()
+        self.pool = Pool(workers, _start_worker,
+                         (program_cache, render_cache))
+        self.uploader = threading.Thread(target=self._upload)
+        self.uploader.daemon = True
+        self.uploader.start()
+
+    def submit(self, job, timeout=None):
+        """Queue `job`, waiting at most `timeout` seconds for room.
+
+        Returns whether the job was queued.
+        """
+        try:
+            self.pending.put(job, timeout=timeout)
+        except Full:
+            return False
+        self.pool.apply_async(_run_job,
+                              (job.source, self.timeout, self.limits,
+                               self.compress_level),
+                              callback=lambda result: self.results.put(
+                                  (job, result)))
+        return True
+
+    def _upload(self):
+        while True:
+            item = self.results.get()
+            if item is None:
+                return
+            job, (png, error) = item
+            try:
+                if error is None:
+                    self.poster.post(job, png)
+                else:
+                    self.poster.error(job, error)
+            except Exception as e:
+                print "Could not post for %s: %s" % (job.user, e)
+            finally:
+                self.pending.get()
+
+    def close(self):
+        """Wait for every queued job to be run and posted."""
+        self.pool.close()
+        self.pool.join()
+        self.results.put(None)
+        self.uploader.join()
@@ -0,0 +1,140 @@
+"""Renders programs for local clients over HTTP.
+
+    python server.py [--host 127.0.0.1] [--port 8000] [--workers N]
+
+POST a program's source to / and the response is the PNG it draws. Programs
+that can't be parsed or run get a 400 with the error as plain text. When
+the server already has as many requests as it accepts at once, it answers
+503 rather than queueing more.
+"""
+import argparse
+import BaseHTTPServer
+import SocketServer
+import threading
+from multiprocessing import Pool, TimeoutError
+
+from pipeline import LIMITS, _run_job, _start_worker
+
+
+# The longest program the server accepts, in bytes.
+MAX_SOURCE = 64 << 10
+
+
+class Busy(Exception):
+    pass
+
+
+class Renderer(object):
+    """Renders programs in a pool of warm worker processes.
+
+    Workers keep their imports and caches between programs, unlike a new
+    interpreter process per program. At most `max_pending` programs may be
+    rendering or waiting for a worker at once, after which `render` raises
+    `Busy`. Each program gets `timeout` seconds and the rest of `limits`.
+    """
+
+    def __init__(self, workers=None, max_pending=16, timeout=10,
+                 limits=LIMITS, compress_level=None, program_cache=None,
+                 render_cache=None):
+        self.timeout = timeout
+        self.limits = limits
+        self.compress_level = compress_level
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.pool = Pool(workers, _start_worker,
+                         (program_cache, render_cache))
+
+    def render(self, source):
+        """Return a (png, error) pair for `source`."""
+        if not self.slots.acquire(False):
+            raise Busy()
+        try:
+            result = self.pool.apply_async(
+                _run_job, (source, self.timeout, self.limits,
+                           self.compress_level))
+            # Workers stop programs themselves a second after the timeout,
+            # so this only gives up on a worker that has stopped answering.
+            return result.get(self.timeout + 5)
+        except TimeoutError:
+            return None, "Program took too long to run"
+        finally:
+            self.slots.release()
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get("Content-Length"))
+        except (TypeError, ValueError):
+            return self.reply(411, "Content-Length is required")
+        if length > MAX_SOURCE:
+            return self.reply(413, "Programs may be at most %d bytes" %
+                                   MAX_SOURCE)
+        source = self.rfile.read(length)
+
+        try:
+            png, error = self.server.renderer.render(source)
+        except Busy:
+            return self.reply(503, "Too busy, try again later")
+        if error is not None:
+            return self.reply(400, error)
+        self.reply(200, png, "image/png")
+
+    def reply(self, status, body, content_type="text/plain"):
+        if content_type == "text/plain":
+            body += "\n"
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, renderer):
+        BaseHTTPServer.HTTPServer.__init__(self, address, Handler)
+        self.renderer = renderer
+
+
+if __name__ == "__main__":
+    cli = argparse.ArgumentParser(description="Render GBC programs over HTTP.")
+    cli.add_argument("--host", default="127.0.0.1",
+                     help="the address to listen on")
+    cli.add_argument("--port", type=int, default=8000,
+                     help="the port to listen on")
+    cli.add_argument("--workers", type=int,
+                     help="how many processes render programs; defaults to "
+                          "one per core")
+    cli.add_argument("--max-pending", type=int, default=16, metavar="N",
+                     help="how many requests may be rendering or waiting at "
+                          "once")
+    cli.add_argument("--timeout", type=int, default=10, metavar="SECONDS",
+                     help="how long each program may run for")
+    cli.add_argument("--compress-level", type=int, metavar="LEVEL",
+                     help="the zlib level to encode PNGs at, from 0 to 9")
+    cli.add_argument("--cache", metavar="PATH",
+                     help="keep parsed programs in a cache saved at PATH")
+    cli.add_argument("--render-cache", metavar="DIRECTORY",
+                     help="keep rendered images in DIRECTORY")
+    args = cli.parse_args()
+
+    renderer = Renderer(workers=args.workers, max_pending=args.max_pending,
+                        timeout=args.timeout,
+                        compress_level=args.compress_level,
+                        program_cache=args.cache,
+                        render_cache=args.render_cache)
+    server = Server((args.host, args.port), renderer)
+    print "Serving on http://%s:%d/" % server.server_address
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        renderer.close()
@@ -0,0 +1,106 @@
+"""Renders large images one tile at a time.
+
+A `TiledCanvas` only records what a program draws. When the image is asked
+for, the recording is rasterized a tile at a time, optionally across
+several processes, so the memory used for drawing depends on the tile size
+rather than the size of the image. Tiles come out exactly as they would in
+a single pass at the same scale, supersampled or not.
+
+Tiles are rasterized with NumPy, like `ArrayCanvas`.
+"""
+from itertools import izip
+from multiprocessing import Pool
+
+import numpy
+from PIL import Image
+
+from arraycanvas import draw_display, gather
+from canvas import Canvas, shrink
+
+
+# The width and height of a tile of the finished image, in pixels.
+TILE_SIZE = 512
+
+
+def render_tile(display, box, supersample=1):
+    """Return the part of the image inside `box` as an RGBA image.
+
+    `box` is (left, upper, right, lower) in the finished image.
+    """
+    left, upper, right, lower = box
+    pixels = numpy.zeros(((lower - upper) * supersample,
+                          (right - left) * supersample, 4), dtype=numpy.uint8)
+    draw_display(display, pixels, (left * supersample, upper * supersample))
+    return shrink(Image.fromarray(pixels, "RGBA"), supersample)
+
+
+# Each worker process keeps the display list it was started with.
+_display = None
+_supersample = 1
+
+def _start_worker(display, supersample):
+    global _display, _supersample
+    _display, _supersample = display, supersample
+
+def _render_tile(box):
+    # Images are sent back as raw bytes, which are cheaper to pickle.
+    return render_tile(_display, box, _supersample).tobytes()
+
+
+class TiledCanvas(Canvas):
+    """A canvas that rasterizes its image a tile at a time.
+
+    Tiles are `tile_size` pixels square, and `workers` processes rasterize
+    them in parallel if it's more than 1.
+    """
+
+    def __init__(self, scale=1, supersample=1, tile_size=TILE_SIZE,
+                 workers=1):
+        super(TiledCanvas, self).__init__(batched=True, scale=scale,
+                                          supersample=supersample)
+        self.tile_size = tile_size
+        self.workers = workers
+
+    def _allocate(self):
+        pass
+
+    def reset(self):
+        self._reset_state()
+
+    def flush(self):
+        # Everything is kept until the tiles are rasterized.
+        self.buffered = 0
+
+    def boxes(self):
+        """Return the (left, upper, right, lower) box of every tile."""
+        width, height = self.size
+        size = self.tile_size
+        return [(left, upper, min(left + size, width),
+                 min(upper + size, height))
+                for upper in xrange(0, height, size)
+                for left in xrange(0, width, size)]
+
+    def tiles(self):
+        """Yield a (box, image) pair for every tile, in rows from the top
+        left."""
+        display = gather(self.runs)
+        boxes = self.boxes()
+        if self.workers is not None and self.workers <= 1:
+            for box in boxes:
+                yield box, render_tile(display, box, self.supersample)
+            return
+
+        pool = Pool(self.workers, _start_worker, (display, self.supersample))
+        try:
+            for box, data in izip(boxes, pool.imap(_render_tile, boxes)):
+                size = box[2] - box[0], box[3] - box[1]
+                yield box, Image.frombytes("RGBA", size, data)
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def get_image(self):
+        image = Image.new("RGBA", self.size)
+        for box, tile in self.tiles():
+            image.paste(tile, box[:2])
+        return image
@@ -0,0 +1,78 @@
+import json
+import sys
+
+from operations import walk
+
+
+class Tracer(object):
+    """Receives structured events from the parser and the interpreter.
+
+    Every event has a kind and a set of named fields. The parser emits
+    `token`, `literal`, `push_block`, `pop_block` and `collapse` events, the
+    interpreter emits a `program` event with the tree it is about to run,
+    and instrumented trees emit an `op` event for every operation executed.
+    Tracing is off unless a tracer is passed in, and nothing is emitted or
+    checked per operation unless the tree has been instrumented.
+
+    `kinds` limits the tracer to the given kinds of events.
+    """
+
+    def __init__(self, kinds=None):
+        self.kinds = frozenset(kinds) if kinds is not None else None
+
+    def __call__(self, kind, **fields):
+        if self.kinds is None or kind in self.kinds:
+            self.emit(kind, fields)
+
+    def emit(self, kind, fields):
+        pass
+
+
+class ListTracer(Tracer):
+    """Keeps every event as a (kind, fields) tuple in `events`."""
+
+    def __init__(self, kinds=None):
+        super(ListTracer, self).__init__(kinds)
+        self.events = []
+
+    def emit(self, kind, fields):
+        self.events.append((kind, fields))
+
+
+class StreamTracer(Tracer):
+    """Writes every event to a stream as a line of JSON."""
+
+    def __init__(self, stream=None, kinds=None):
+        super(StreamTracer, self).__init__(kinds)
+        self.stream = stream or sys.stderr
+
+    def emit(self, kind, fields):
+        fields["event"] = kind
+        self.stream.write(json.dumps(fields, default=repr) + "\n")
+
+
+def instrument(block, tracer):
+    """Make every operation in `block` emit an `op` event when it runs.
+
+    Nodes have no `__dict__` to override `run` in, so each one is switched
+    to a subclass of its class that traces it.
+    """
+    classes = {}
+    for node in walk(block):
+        cls = type(node)
+        if cls in classes.values():
+            # A shared node, like a literal, that's already instrumented.
+            continue
+        if cls not in classes:
+            classes[cls] = _traced(cls, tracer)
+        node.__class__ = classes[cls]
+    return block
+
+
+def _traced(cls, tracer):
+    name = cls.__name__
+    def run(self, context):
+        result = cls.run(self, context)
+        tracer("op", op=name, result=result)
+        return result
+    return type(cls)(name, (cls, ), {"run": run})
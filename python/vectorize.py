@@ -0,0 +1,474 @@
+"""Runs simple drawing loops all at once with NumPy.
+
+Loops like `L360 r0.017453292 P)` only move the origin, do arithmetic on
+variables and draw. `vectorize` finds those loops in an optimized tree and
+makes them `VectorLoop`s. When a program is run with `vectorize`, a
+`VectorLoop` works out every iteration at once as NumPy arrays and draws
+them in one batch, leaving the variables and canvas exactly as running the
+loop one iteration at a time would. Whatever it can't do exactly the same
+way, like integers that could overflow, it leaves to the interpreter.
+
+NumPy is optional, and is only imported when a loop is first vectorized.
+"""
+import operator
+
+from operations import (AssignOperation, BreakInterrupt, CursorStatement2,
+                        DotStatement, HSLStatement3, HSLStatement4,
+                        HoistedExpression, Literal, LoopBlock, MultOperation,
+                        NegateOperation, PathStatement, PlusOperation,
+                        RGBStatement3, RGBStatement4, RotateStatement,
+                        SlotRead, SlotWrite, SubOperation,
+                        TranslateStatement2, hsl_to_rgb)
+
+
+# Loops that run fewer times than this are quicker to run one at a time.
+MIN_ITERATIONS = 32
+
+# Integers are only vectorized while they're smaller than this, so that
+# adding or multiplying two of them can't overflow 64 bits like Python's
+# integers never do.
+INT_LIMIT = 1 << 31
+
+ARITHMETIC = {PlusOperation: operator.add, SubOperation: operator.sub,
+              MultOperation: operator.mul}
+COLORS = {RGBStatement3: "rgb", RGBStatement4: "rgba", HSLStatement3: "hsl",
+          HSLStatement4: "hsl"}
+
+
+class Unsupported(Exception):
+    """Raised when a loop can't be run as arrays exactly like the
+    interpreter would run it."""
+
+
+class VectorLoop(LoopBlock):
+    """A loop that can be run as arrays, following `steps`, which `plan`
+    made from its body.
+
+    It runs like any other loop unless the context asks for loops to be
+    vectorized.
+    """
+    __slots__ = ("steps", )
+    name = "Vector Loop"
+    def __init__(self, loop, steps):
+        super(VectorLoop, self).__init__()
+        self.first = loop.first
+        self.body = loop.body
+        self.hoisted = loop.hoisted
+        self.position = getattr(loop, "position", None)
+        self.steps = steps
+
+    def run(self, context):
+        if not context.vectorize:
+            return super(VectorLoop, self).run(context)
+        try:
+            count = self.first.run(context)
+            if not (type(count) in (int, long) and count >= MIN_ITERATIONS and
+                    run_steps(self.steps, context, count)):
+                self.repeat(context, count)
+        except BreakInterrupt:
+            pass
+
+
+def vectorize(block):
+    """Make the loops in an optimized tree that can be run as arrays into
+    `VectorLoop`s.
+
+    This has to come after `resolve_slots`, since only variables in slots
+    are followed from one iteration to the next.
+    """
+    def rewrite(node):
+        node.map_children(rewrite)
+        if type(node) is LoopBlock:
+            steps = plan(node)
+            if steps is not None:
+                return VectorLoop(node, steps)
+        return node
+
+    block.map_children(rewrite)
+    return block
+
+
+def plan(loop):
+    """Return the steps that run `loop`'s body, or None if it does anything
+    but transform, move the cursor, draw, set colors that don't change from
+    one iteration to the next, and assign sums and products to variables
+    in slots.
+
+    Each step is a tuple starting with its kind, followed by expressions as
+    `_expression` returns them.
+    """
+    written = set()
+    for node in loop.body:
+        if isinstance(node, SlotWrite):
+            if node.index in written:
+                return None
+            written.add(node.index)
+
+    steps = []
+    transform = None
+    try:
+        for node in loop.body:
+            kind = type(node)
+            if kind is DotStatement:
+                steps.append(("dot", ))
+            elif kind is PathStatement:
+                steps.append(("line", ))
+            elif kind in (RotateStatement, TranslateStatement2):
+                # Only the top transform is updated in place, so a loop
+                # that alternates between transforms stacks up new ones.
+                if transform not in (None, kind):
+                    return None
+                transform = kind
+                if kind is RotateStatement:
+                    steps.append(("rotate", _expression(node.body, written)))
+                else:
+                    steps.append(("translate", _expression(node.x, written),
+                                  _expression(node.y, written)))
+            elif kind is CursorStatement2:
+                steps.append(("cursor", _expression(node.x, written),
+                              _expression(node.y, written)))
+            elif kind in COLORS:
+                values = [_expression(v, written) for v in node.children()]
+                if any(value[0] != "const" for value in values):
+                    return None
+                steps.append(("color", COLORS[kind], values))
+            elif kind is SlotWrite:
+                steps.append(("set", node.index,
+                              _expression(node.value, written)))
+            else:
+                return None
+    except Unsupported:
+        return None
+    return tuple(steps)
+
+
+def _expression(node, written):
+    """Return `node` as ("const", node) if it's the same in every iteration,
+    or as arithmetic on those and the variables the loop assigns to."""
+    if isinstance(node, HoistedExpression):
+        node = node.expr
+    if _invariant(node, written):
+        return ("const", node)
+    if isinstance(node, SlotRead):
+        return ("slot", node.index)
+    if type(node) in ARITHMETIC:
+        return (type(node), _expression(node.left, written),
+                _expression(node.right, written))
+    if type(node) is NegateOperation:
+        return (NegateOperation, _expression(node.body, written))
+    raise Unsupported()
+
+
+def _invariant(node, written):
+    if isinstance(node, Literal):
+        return True
+    if isinstance(node, SlotRead):
+        return node.index not in written
+    if isinstance(node, AssignOperation):
+        # Arguments, which the loop can't assign to without being refused.
+        return isinstance(node.body, Literal)
+    if not node.foldable:
+        return False
+    return all(_invariant(n, written) for n in node.children())
+
+
+def run_steps(steps, context, count):
+    """Run `count` iterations of `steps` as arrays and return True, or
+    return False having changed nothing if they can't be."""
+    try:
+        import numpy
+    except ImportError:
+        return False
+    budget = context.budget
+    # Working out the iterations takes time and memory that the budget
+    # doesn't see, so loops that won't fit in it are run step by step.
+    if budget is not None and not budget.allows(count):
+        return False
+    try:
+        with numpy.errstate(all="ignore"):
+            iterations = _Iterations(numpy, steps, context, count)
+            iterations.evaluate()
+    except Exception:
+        # Running the loop normally raises whatever error there was where
+        # the program would have raised it.
+        return False
+
+    if budget is not None and not budget.leap(context, count):
+        return False
+    iterations.apply()
+    return True
+
+
+class _Iterations(object):
+    """Works out what every iteration of a loop does, and then does it.
+
+    A value is a number that's the same in every iteration, or an array with
+    its value in each. Where a step reads a variable, it gets the value it
+    was given earlier in the same iteration or, if it hasn't been yet, the
+    one from the iteration before.
+    """
+
+    def __init__(self, numpy, steps, context, count):
+        self.numpy = numpy
+        self.steps = steps
+        self.context = context
+        self.canvas = context.canvas
+        self.count = count
+        self.writes = dict((step[1], position)
+                           for position, step in enumerate(steps)
+                           if step[0] == "set")
+        self.after = {}
+        self.pending = set()
+
+    def evaluate(self):
+        numpy, steps, canvas = self.numpy, self.steps, self.canvas
+        count = self.count
+
+        # The origin, which is all of the transforms that the cursor uses,
+        # before and after each transform step of every iteration.
+        self.transform = None
+        transforms = [position for position, step in enumerate(steps)
+                      if step[0] in ("rotate", "translate")]
+        origins = None
+        if transforms:
+            origins = self.origins(transforms)
+        entry = self.number(canvas.matrix[4]), self.number(canvas.matrix[5])
+
+        cursors = [position for position, step in enumerate(steps)
+                   if step[0] == "cursor"]
+        cursor_values = {}
+        for position in cursors:
+            x, y = steps[position][1:]
+            cursor_values[position] = (self.value(x, position),
+                                       self.value(y, position))
+
+        # Colors are numbered in the order they're set, with the color the
+        # loop starts with as -1.
+        colors = [position for position, step in enumerate(steps)
+                  if step[0] == "color"]
+        self.colors = [self.color(steps[position]) for position in colors]
+        color_ids = dict(zip(colors, range(len(colors))))
+
+        xs, ys, event_colors, self.lines = [], [], [], []
+        ops = numpy.arange(count) * len(transforms)
+        for position, step in enumerate(steps):
+            if step[0] not in ("dot", "line"):
+                continue
+            self.lines.append(step[0] == "line")
+
+            if origins is None:
+                e, f = entry
+            else:
+                done = sum(1 for t in transforms if t < position)
+                e, f = origins[0][ops + done], origins[1][ops + done]
+                if self.transform[2] is None and not done:
+                    # Nothing has been pushed yet in the first iteration.
+                    e = numpy.concatenate(([entry[0]], e[1:]))
+                    f = numpy.concatenate(([entry[1]], f[1:]))
+
+            x, y = self.latest(cursors, position, cursor_values,
+                               tuple(map(self.number, canvas.cursor)))
+            xs.append(self.full(e + x))
+            ys.append(self.full(f + y))
+
+            event_colors.append(self.latest(colors, position, color_ids, -1))
+
+        if xs:
+            xs = numpy.column_stack(xs).ravel()
+            ys = numpy.column_stack(ys).ravel()
+            if not (numpy.isfinite(xs).all() and numpy.isfinite(ys).all()):
+                raise Unsupported()
+            self.color_ids = numpy.column_stack(
+                [self.full(c) for c in event_colors]).ravel()
+        self.xs, self.ys = xs, ys
+        self.cursor = None
+        if cursors:
+            x, y = cursor_values[cursors[-1]]
+            self.cursor = self.last(x), self.last(y)
+        self.slots = dict((index, self.last(self.variable(index)))
+                          for index in self.writes)
+
+    def apply(self):
+        canvas, slots = self.canvas, self.context.slots
+        for index, value in self.slots.iteritems():
+            slots[index] = value
+            self.context.assigned[index] = True
+        if self.cursor is not None:
+            canvas.set_cursor(*self.cursor)
+
+        if self.transform is not None:
+            kind, cls, top, values = self.transform
+            if top is None:
+                # The top transform isn't one of these, so this pushes one.
+                getattr(canvas, kind)(*values)
+            else:
+                canvas.replace(cls(*values))
+
+        if len(self.xs):
+            entry = canvas.color
+            colors = self.colors
+            xs, ys = self.xs.tolist(), self.ys.tolist()
+            lines = self.lines * self.count
+            ids = self.color_ids
+            changes = [0] + (self.numpy.flatnonzero(ids[1:] != ids[:-1]) +
+                             1).tolist() + [len(xs)]
+            for start, end in zip(changes, changes[1:]):
+                color_id = ids[start]
+                canvas.color = entry if color_id < 0 else colors[color_id]
+                canvas.plot(xs[start:end], ys[start:end], lines[start:end])
+        if self.colors:
+            canvas.color = self.colors[-1]
+
+    def origins(self, transforms):
+        """Return arrays of the origin's x and y after 0, 1, 2... of the
+        transform steps have run, counting through every iteration."""
+        numpy, steps, canvas = self.numpy, self.steps, self.canvas
+        kind = steps[transforms[0]][0]
+        top = canvas.transforms[-1] if canvas.transforms else None
+        if kind == "rotate":
+            from canvas import RotateTransform as cls
+            start = ("theta", )
+        else:
+            from canvas import TranslateTransform as cls
+            start = ("x", "y")
+        if not isinstance(top, cls):
+            # The first step pushes a transform, and the rest update it.
+            top = None
+            below = canvas.matrix
+        else:
+            below = (canvas.matrices[-2] if len(canvas.matrices) > 1 else
+                     (1, 0, 0, 1, 0, 0))
+
+        totals = []
+        for axis in range(len(start)):
+            steps_ = numpy.column_stack(
+                [self.full(self.value(steps[t][axis + 1], t))
+                 for t in transforms]).ravel()
+            if top is None:
+                # A placeholder for before the first step, which is never
+                # used.
+                total = numpy.concatenate(([0], numpy.cumsum(steps_)))
+            else:
+                first = self.number(getattr(top, start[axis]))
+                total = numpy.cumsum(numpy.concatenate(([first], steps_)))
+            totals.append(self.checked(total))
+        self.transform = (kind, cls, top,
+                          [self.last(total) for total in totals])
+
+        e, f = self.number(below[4]), self.number(below[5])
+        if kind == "rotate":
+            theta, = totals
+            if not numpy.isfinite(theta).all():
+                raise Unsupported()
+            cos, sin = numpy.cos(theta), numpy.sin(theta)
+            return e * cos - f * sin, f * cos + e * sin
+        x, y = totals
+        return e + x, f + y
+
+    def color(self, step):
+        """Return the color a color step sets."""
+        mode, values = step[1], [self.value(v, 0) for v in step[2]]
+        canvas = self.canvas
+        color = canvas.color
+        try:
+            if mode == "hsl":
+                # HSL colors are always opaque.
+                canvas.set_color(*hsl_to_rgb(*values[:3]), mode="rgb")
+            else:
+                canvas.set_color(*values, mode=mode)
+            return canvas.color
+        finally:
+            canvas.color = color
+
+    def latest(self, positions, position, values, entry):
+        """Return the value that the last of the steps at `positions` before
+        `position` gave, in each iteration."""
+        before = [p for p in positions if p < position]
+        if before:
+            return values[before[-1]]
+        if not positions:
+            return entry
+        # It was last set in the iteration before.
+        value = values[positions[-1]]
+        if isinstance(value, tuple):
+            return tuple(self.shift(start, v)
+                         for start, v in zip(entry, value))
+        return self.shift(entry, value)
+
+    def value(self, expression, position):
+        """Return the value of an expression in the step at `position`."""
+        kind = expression[0]
+        if kind == "const":
+            return self.number(expression[1].run(self.context))
+        if kind == "slot":
+            index = expression[1]
+            if self.writes[index] < position:
+                return self.variable(index)
+            return self.shift(self.number(self.context.slots[index]),
+                              self.variable(index))
+        if kind is NegateOperation:
+            return self.checked(self.value(expression[1], position) * -1)
+        return self.checked(ARITHMETIC[kind](
+            self.value(expression[1], position),
+            self.value(expression[2], position)))
+
+    def variable(self, index):
+        """Return the value a variable is given in each iteration."""
+        if index in self.after:
+            return self.after[index]
+        if index in self.pending:
+            # It depends on itself in some way other than a running sum.
+            raise Unsupported()
+        self.pending.add(index)
+        position = self.writes[index]
+        expression = self.steps[position][2]
+        kind = expression[0]
+        if (kind in (PlusOperation, SubOperation) and
+                expression[1] == ("slot", index)):
+            step = self.value(expression[2], position)
+            if kind is SubOperation:
+                step = self.checked(step * -1)
+        elif kind is PlusOperation and expression[2] == ("slot", index):
+            step = self.value(expression[1], position)
+        else:
+            step = None
+        if step is None:
+            value = self.value(expression, position)
+        else:
+            # Adding the negation is exactly the same as subtracting.
+            start = self.number(self.context.slots[index])
+            value = self.checked(self.numpy.cumsum(self.numpy.concatenate(
+                ([start], self.full(step))))[1:])
+        self.pending.discard(index)
+        self.after[index] = value
+        return value
+
+    def shift(self, start, value):
+        """Return the values from the iteration before each iteration."""
+        return self.numpy.concatenate(([start], self.full(value)[:-1]))
+
+    def full(self, value):
+        if isinstance(value, self.numpy.ndarray):
+            return value
+        return self.numpy.full(self.count, value)
+
+    def last(self, value):
+        if isinstance(value, self.numpy.ndarray):
+            return value[-1].item()
+        return value
+
+    def number(self, value):
+        if type(value) is float or (type(value) in (int, long) and
+                                    abs(value) < INT_LIMIT):
+            return value
+        raise Unsupported()
+
+    def checked(self, value):
+        if not isinstance(value, self.numpy.ndarray):
+            return self.number(value)
+        if value.dtype.kind == "i":
+            if len(value) and abs(value).max() >= INT_LIMIT:
+                raise Unsupported()
+        elif value.dtype.kind != "f":
+            raise Unsupported()
+        return value
@@ -0,0 +1,1024 @@
+"""Runs programs as bytecode on a stack machine.
+
+`lower` flattens a parsed program into a `Program`: an array of opcodes,
+each followed by its operands, for the program and for each function it
+defines. Jumps replace the nesting of loops, conditionals and short-circuit
+operators, so running it is one loop over the array rather than a method
+call for every node. Each instruction still costs about as much as a method
+call would, though, so it runs about as fast as walking the tree does; the
+compiler is the engine to use for speed. `disassemble` lists the
+instructions.
+
+    python vm.py ../tests/circle.gbc
+"""
+import math
+import operator
+from array import array
+
+import gbcmath
+from contexts import (MISS, StackOverflow, restore_arguments,
+                      save_arguments)
+from operations import *
+
+
+# Every opcode, numbered in order, with the kinds of its operands. The VM
+# tests which range an opcode falls in and then tests for the opcodes in it
+# in this order, so the common ones come first.
+OPCODES = [
+    ("CONST", ("const", )),
+    ("LOAD_SLOT", ("slot", )),
+    ("SET_SLOT", ("slot", )),
+    ("LOAD_VAR", ("const", )),
+    ("SET_VAR", ("const", )),
+    ("LOAD_HOIST", ("hoist", "jump")),
+    ("ADD", ()),
+    ("SUB", ()),
+    ("MUL", ()),
+    ("DIV", ()),
+    ("MOD", ()),
+    ("POW", ()),
+    ("GT", ()),
+    ("GTE", ()),
+    ("EQ", ()),
+    ("NE", ()),
+    ("ADD_CONST", ("const", )),
+    ("SUB_CONST", ("const", )),
+    ("MUL_CONST", ("const", )),
+    ("DIV_CONST", ("const", )),
+    ("MOD_CONST", ("const", )),
+    ("POW_CONST", ("const", )),
+    ("GT_CONST", ("const", )),
+    ("GTE_CONST", ("const", )),
+    ("EQ_CONST", ("const", )),
+    ("NE_CONST", ("const", )),
+    ("JUMP_IF_ZERO", ("jump", )),
+    ("JUMP_IF_FALSE", ("jump", )),
+    ("JUMP", ("jump", )),
+    ("FOR_ITER", ("jump", )),
+    ("POP", ()),
+    ("DUP", ()),
+    ("DOT", ()),
+    ("LINE", ()),
+    ("ROTATE_CONST", ("const", )),
+    ("TRANSLATE_CONST", ("const", "const")),
+    ("CURSOR_CONST", ("const", "const")),
+    ("SET_COLOR", ("count", )),
+    ("HSL", ("count", )),
+    ("CURSOR", ()),
+    ("TRANSLATE", ()),
+    ("ROTATE", ()),
+    ("SCALE", ()),
+    ("CLEAR", ()),
+    ("POP_MATRIX", ()),
+    ("SIN", ()),
+    ("COS", ()),
+    ("TAN", ()),
+    ("SEC", ()),
+    ("CSC", ()),
+    ("COT", ()),
+    ("ASIN", ()),
+    ("ACOS", ()),
+    ("ATAN", ()),
+    ("ASEC", ()),
+    ("ACSC", ()),
+    ("ACOT", ()),
+    ("NEG", ()),
+    ("NOT", ()),
+    ("FLOOR", ()),
+    ("CEIL", ()),
+    ("SQUARE", ()),
+    ("SQRT", ()),
+    ("XOR", ()),
+    ("AND_JUMP", ("jump", )),
+    ("OR_JUMP", ("jump", )),
+    ("ANY_JUMP", ("jump", )),
+    ("SUM", ("count", )),
+    ("BUILD_TUPLE", ("count", )),
+    ("ASSIGN", ()),
+    ("ASSIGN_KEY", ()),
+    ("CALL", ("count", )),
+    ("RETURN", ()),
+    ("DEF_FUNC", ("function", )),
+    ("RAISE_BREAK", ()),
+    ("GET_ITER", ()),
+    ("SET_HOIST", ("hoist", )),
+    ("UNSET_HOIST", ("hoist", )),
+    ("NODE", ("node", )),
+]
+
+OPNAMES = [name for name, _ in OPCODES]
+OPERANDS = [operands for _, operands in OPCODES]
+for _number, _name in enumerate(OPNAMES):
+    globals()[_name] = _number
+del _number, _name
+
+
+BINARY = {
+    PlusOperation: ADD,
+    SubOperation: SUB,
+    MultOperation: MUL,
+    DivOperation: DIV,
+    ModOperation: MOD,
+    PowOperation: POW,
+    GTOperation: GT,
+    GTEOperation: GTE,
+    EqualOperation: EQ,
+    DNEOperation: NE,
+}
+
+UNARY = {
+    NegateOperation: NEG,
+    NotOperation: NOT,
+    SinOperation: SIN,
+    CosOperation: COS,
+    TanOperation: TAN,
+    SecOperation: SEC,
+    CscOperation: CSC,
+    CotOperation: COT,
+    FloorOperation: FLOOR,
+    CeilOperation: CEIL,
+    SquareOperation: SQUARE,
+    SqRootOperation: SQRT,
+}
+
+INVERSES = {
+    SinOperation: ASIN,
+    CosOperation: ACOS,
+    TanOperation: ATAN,
+    SecOperation: ASEC,
+    CscOperation: ACSC,
+    CotOperation: ACOT,
+}
+
+CANVAS_CALLS = {
+    DotStatement: DOT,
+    PathStatement: LINE,
+    ClearMatStatement: CLEAR,
+    PopMatStatement: POP_MATRIX,
+}
+
+# The versions of the canvas opcodes that take literal arguments with them.
+CONST_CANVAS = {
+    CURSOR: CURSOR_CONST,
+    TRANSLATE: TRANSLATE_CONST,
+}
+
+
+class Code(object):
+    """The instructions of the program or of one of its functions.
+
+    `handlers` holds a (start, end, target, depth, exception) entry for each
+    range of instructions that catches an exception: if one of the
+    instructions raises it, the stack is cut back to `depth` values and the
+    VM jumps to `target`. `hoists` is the number of hoisted values it keeps.
+    Functions have the `reads` of the FunctionBlock they were lowered from.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.ops = array("i")
+        self.handlers = []
+        self.hoists = 0
+        self.reads = None
+
+
+class Program(object):
+    """A lowered program, called with a context to run it.
+
+    The program's own code is `main`, and the code of the functions it
+    defines is in `functions`. They share `constants`, and `nodes` holds the
+    nodes that are run with their tree walking `run()` method.
+    """
+
+    def __init__(self, slots=None):
+        self.main = None
+        self.functions = []
+        self.constants = []
+        self.nodes = []
+        self.slots = slots
+
+    def __call__(self, context):
+        if self.slots is None:
+            execute(self, self.main, context)
+            return
+        context.use_slots(self.slots)
+        try:
+            execute(self, self.main, context)
+        finally:
+            context.store_slots()
+
+
+class Assembler(object):
+    """Lowers a syntax tree into a `Program`.
+
+    Nodes that the assembler doesn't know how to lower (or that are
+    malformed and would raise at runtime) are run with their tree walking
+    `run()` method, so lowered programs behave exactly like interpreted
+    ones.
+    """
+
+    def __init__(self, block):
+        self.tree = block
+        self.program = Program(getattr(block, "slots", None))
+        self.known = {}
+        self.code = None
+        # The break jumps to patch for each loop around the code being
+        # lowered, and how many loop counters are on the stack.
+        self.loops = []
+        self.depth = 0
+        self.hoisted = {}
+
+    def emit(self, op, *operands):
+        self.code.ops.append(op)
+        self.code.ops.extend(operands)
+
+    def jump(self, op, *operands):
+        """Emit a jump whose target is patched in later, and return where
+        the target goes."""
+        self.emit(op, *(operands + (-1, )))
+        return len(self.code.ops) - 1
+
+    def here(self):
+        return len(self.code.ops)
+
+    def patch(self, index, target=None):
+        self.code.ops[index] = self.here() if target is None else target
+
+    def const(self, value):
+        # 1, 1.0 and True are equal but still have to stay distinct, and so
+        # do 0.0 and -0.0.
+        key = type(value), value
+        if type(value) is float:
+            key += (math.copysign(1, value), )
+        if key not in self.known:
+            self.known[key] = len(self.program.constants)
+            self.program.constants.append(value)
+        return self.known[key]
+
+    def fallback(self, node):
+        node = replace_calls(node,
+                             lambda call: _FallbackCall(call, self.program))
+        self.program.nodes.append(node)
+        self.emit(NODE, len(self.program.nodes) - 1)
+
+    def value(self, node):
+        """Emit code that pushes the value of the expression `node`."""
+        if isinstance(node, Literal):
+            self.emit(CONST, self.const(node.value))
+        elif isinstance(node, LiteralTuple):
+            self.emit(CONST, self.const(node.constant))
+        elif isinstance(node, Continuation):
+            for v in node.value:
+                self.value(v)
+            self.emit(BUILD_TUPLE, len(node.value))
+
+        elif type(node) in BINARY:
+            self.value(node.left)
+            if isinstance(node.right, Literal):
+                # The `_CONST` versions take their right operand with them.
+                self.emit(BINARY[type(node)] + ADD_CONST - ADD,
+                          self.const(node.right.value))
+            else:
+                self.value(node.right)
+                self.emit(BINARY[type(node)])
+        elif type(node) in UNARY:
+            self.value(node.body)
+            self.emit(UNARY[type(node)])
+        elif (isinstance(node, TrigInverterOperation) and
+                type(node.body) in INVERSES):
+            self.value(node.body.body)
+            self.emit(INVERSES[type(node.body)])
+
+        elif isinstance(node, SlotRead):
+            self.emit(LOAD_SLOT, node.index)
+        elif isinstance(node, SlotWrite):
+            self.value(node.value)
+            self.emit(DUP)
+            self.emit(SET_SLOT, node.index)
+        elif isinstance(node, AssignOperation):
+            self.assign(node)
+        elif isinstance(node, HoistedExpression):
+            if node in self.hoisted:
+                # Evaluated the first time it's reached, then kept.
+                end = self.jump(LOAD_HOIST, self.hoisted[node])
+                self.value(node.expr)
+                self.emit(DUP)
+                self.emit(SET_HOIST, self.hoisted[node])
+                self.patch(end)
+            else:
+                self.value(node.expr)
+        elif isinstance(node, CallOperation):
+            if isinstance(node.body, Continuation) and node.body.value:
+                for v in node.body.value:
+                    self.value(v)
+                self.emit(CALL, len(node.body.value))
+            else:
+                self.value(node.body)
+                self.emit(CALL, 0)
+
+        elif tuple_arguments(node, AndOperation, 2):
+            left, right = tuple_arguments(node, AndOperation, 2)
+            self.value(left)
+            end = self.jump(AND_JUMP)
+            self.value(right)
+            self.patch(end)
+        elif tuple_arguments(node, OrOperation, 2):
+            left, right = tuple_arguments(node, OrOperation, 2)
+            self.value(left)
+            end = self.jump(OR_JUMP)
+            self.value(right)
+            self.patch(end)
+        elif tuple_arguments(node, IffOperation, 3):
+            condition, left, right = tuple_arguments(node, IffOperation, 3)
+            self.value(condition)
+            other = self.jump(JUMP_IF_FALSE)
+            self.value(left)
+            end = self.jump(JUMP)
+            self.patch(other)
+            self.value(right)
+            self.patch(end)
+        elif tuple_arguments(node, XOROperation, 2):
+            left, right = tuple_arguments(node, XOROperation, 2)
+            self.value(left)
+            self.value(right)
+            self.emit(XOR)
+
+        elif isinstance(node, AnyBlock):
+            ends = []
+            for op in node.body:
+                self.result(op)
+                ends.append(self.jump(ANY_JUMP))
+            self.emit(CONST, self.const(0))
+            for end in ends:
+                self.patch(end)
+        elif isinstance(node, AllBlock):
+            fails = []
+            for op in node.body:
+                self.result(op)
+                fails.append(self.jump(JUMP_IF_FALSE))
+            self.emit(CONST, self.const(1))
+            end = self.jump(JUMP)
+            for fail in fails:
+                self.patch(fail)
+            self.emit(CONST, self.const(0))
+            self.patch(end)
+        elif isinstance(node, SumBlock):
+            for op in node.body:
+                self.result(op)
+            self.emit(SUM, len(node.body))
+        else:
+            self.fallback(node)
+
+    def assign(self, node):
+        args = tuple_values(node.body, 2)
+        if args and isinstance(args[0], Literal):
+            # Literal keys that could be in a slot have been given one.
+            self.value(args[1])
+            self.emit(DUP)
+            self.emit(SET_VAR, self.const(args[0].value))
+        elif args:
+            self.value(args[0])
+            self.value(args[1])
+            self.emit(ASSIGN_KEY)
+        elif isinstance(node.body, Continuation):
+            self.fallback(node)
+        elif isinstance(node.body, Literal):
+            self.emit(LOAD_VAR, self.const(node.body.value))
+        else:
+            self.value(node.body)
+            self.emit(ASSIGN)
+
+    def result(self, node):
+        """Emit code that pushes whatever running `node` returns."""
+        if isinstance(node, (Literal, Expression, AnyBlock, AllBlock,
+                             SumBlock)):
+            self.value(node)
+        else:
+            self.stmt(node)
+            self.emit(CONST, self.const(None))
+
+    def stmt(self, node):
+        """Emit code that runs `node` and leaves the stack as it was."""
+        if isinstance(node, Literal):
+            return
+
+        args = tuple_values(getattr(node, "body", None), 2)
+        if (isinstance(node, AssignOperation) and args and
+                isinstance(args[0], Literal)):
+            self.value(args[1])
+            self.emit(SET_VAR, self.const(args[0].value))
+            return
+        if isinstance(node, SlotWrite):
+            self.value(node.value)
+            self.emit(SET_SLOT, node.index)
+            return
+
+        for cls, op, lengths in [(RGBStatement, SET_COLOR, (3, 4)),
+                                 (HSLStatement, HSL, (3, 4)),
+                                 (CursorStatement, CURSOR, (2, )),
+                                 (TranslateStatement, TRANSLATE, (2, ))]:
+            args = tuple_arguments(node, cls, *lengths)
+            if (op in CONST_CANVAS and args and
+                    all(isinstance(arg, Literal) for arg in args)):
+                self.emit(CONST_CANVAS[op],
+                          *[self.const(arg.value) for arg in args])
+                return
+            if args:
+                for arg in args:
+                    self.value(arg)
+                if cls in (RGBStatement, HSLStatement):
+                    self.emit(op, len(args))
+                else:
+                    self.emit(op)
+                return
+
+        if isinstance(node, BreakStatement):
+            if self.loops:
+                self.loops[-1].append(self.jump(JUMP))
+            else:
+                self.emit(RAISE_BREAK)
+        elif type(node) in CANVAS_CALLS:
+            self.emit(CANVAS_CALLS[type(node)])
+        elif isinstance(node, ScaleStatement) and tuple_values(node.body, 2):
+            for v in node.body.value:
+                self.value(v)
+            self.emit(SCALE)
+        elif (isinstance(node, RotateStatement) and
+                isinstance(node.body, Literal)):
+            self.emit(ROTATE_CONST, self.const(node.body.value))
+        elif isinstance(node, RotateStatement):
+            self.value(node.body)
+            self.emit(ROTATE)
+
+        elif isinstance(node, LoopBlock):
+            self.loop(node)
+        elif isinstance(node, ConditionalBlock):
+            self.value(node.first)
+            end = self.jump(JUMP_IF_ZERO)
+            for op in node.body:
+                self.stmt(op)
+            self.patch(end)
+        elif isinstance(node, FunctionBlock):
+            self.function(node)
+        elif type(node) is BlockOperation:
+            for op in node.body:
+                self.stmt(op)
+
+        elif isinstance(node, (Expression, AnyBlock, AllBlock, SumBlock)):
+            self.value(node)
+            self.emit(POP)
+        else:
+            self.fallback(node)
+            self.emit(POP)
+
+    def loop(self, node):
+        start = self.here()
+        outer = self.depth
+        self.value(node.first)
+        # The loop's counter stays on the stack while it runs.
+        self.emit(GET_ITER)
+        self.depth += 1
+
+        for h in node.hoisted:
+            self.hoisted[h] = index = self.code.hoists
+            self.code.hoists += 1
+            self.emit(UNSET_HOIST, index)
+
+        # The counter is tested at the bottom, so that every pass through
+        # the body dispatches one jump rather than two.
+        test = self.jump(JUMP)
+        top = self.here()
+        self.loops.append([])
+        for op in node.body:
+            self.stmt(op)
+        self.patch(test)
+        self.emit(FOR_ITER, top)
+        for jump in self.loops.pop():
+            self.patch(jump)
+        broken = self.here()
+        self.emit(POP)
+        self.depth = outer
+        # A `;` inside of a function called from the loop is raised, and
+        # stops the loop wherever its counter has got to.
+        self.code.handlers.append((start, broken, self.here(), outer,
+                                   BreakInterrupt))
+
+    def thread(self):
+        """Send jumps that land on a `JUMP` straight to where it goes."""
+        ops = self.code.ops
+        pc = 0
+        while pc < len(ops):
+            operands = OPERANDS[ops[pc]]
+            for index, kind in enumerate(operands, pc + 1):
+                if kind == "jump":
+                    while ops[ops[index]] == JUMP:
+                        ops[index] = ops[ops[index] + 1]
+            pc += 1 + len(operands)
+
+    def function(self, node):
+        index = len(self.program.functions)
+        saved = self.code, self.loops, self.depth, self.hoisted
+        self.code = Code("function %d" % index)
+        self.code.reads = node.reads
+        self.loops, self.depth, self.hoisted = [], 0, {}
+
+        body = list(node.body)
+        last = body.pop() if body else None
+        for op in body:
+            self.stmt(op)
+        if last is None:
+            self.emit(CONST, self.const(0))
+        else:
+            self.result(last)
+        self.emit(RETURN)
+        self.thread()
+
+        self.program.functions.append(self.code)
+        self.code, self.loops, self.depth, self.hoisted = saved
+        self.value(node.first)
+        self.emit(DEF_FUNC, index)
+
+    def assemble(self):
+        self.code = self.program.main = Code("main")
+        for op in self.tree.body:
+            self.stmt(op)
+        self.emit(CONST, self.const(None))
+        self.emit(RETURN)
+        self.thread()
+        return self.program
+
+
+def lower(block):
+    """Lower a parsed program into a `Program` that accepts a context."""
+    return Assembler(block).assemble()
+
+
+_UNSET = object()
+
+
+def _sqrt(out):
+    if isinstance(out, tuple):
+        base, degree = out
+        return base ** (1 / degree)
+    return math.sqrt(out)
+
+
+# The opcodes `execute` keeps in locals.
+_HOT = (CONST, LOAD_SLOT, SET_SLOT, LOAD_VAR, SET_VAR, LOAD_HOIST, NE,
+        NE_CONST, JUMP_IF_ZERO, JUMP_IF_FALSE, JUMP, FOR_ITER, POP, DUP,
+        POP_MATRIX, DOT, LINE, ROTATE_CONST, TRANSLATE_CONST, CURSOR_CONST,
+        SET_COLOR, HSL, CURSOR, TRANSLATE, ROTATE, SCALE, CLEAR, SQRT, XOR)
+
+# The functions that run the binary and unary operators, by opcode. The
+# sec, csc and cot functions are looked up as they're called so that they
+# follow `gbcmath.use_mpmath()`.
+_BINARY = [None] * len(OPCODES)
+_UNARY = [None] * len(OPCODES)
+for _op, _fn in [(ADD, operator.add), (SUB, operator.sub),
+                 (MUL, operator.mul), (DIV, operator.div),
+                 (MOD, operator.mod), (POW, operator.pow),
+                 (GT, operator.gt), (GTE, operator.ge),
+                 (EQ, operator.eq), (NE, operator.ne)]:
+    _BINARY[_op] = _BINARY[_op + ADD_CONST - ADD] = _fn
+for _op, _fn in [(SIN, math.sin), (COS, math.cos), (TAN, math.tan),
+                 (SEC, lambda x: gbcmath.sec(x)),
+                 (CSC, lambda x: gbcmath.csc(x)),
+                 (COT, lambda x: gbcmath.cot(x)),
+                 (ASIN, math.asin), (ACOS, math.acos), (ATAN, math.atan),
+                 (ASEC, lambda x: gbcmath.asec(x)),
+                 (ACSC, lambda x: gbcmath.acsc(x)),
+                 (ACOT, lambda x: gbcmath.acot(x)),
+                 (NEG, lambda x: x * -1), (NOT, lambda x: x == 0),
+                 (FLOOR, math.floor), (CEIL, math.ceil),
+                 (SQUARE, lambda x: x ** 2), (SQRT, _sqrt)]:
+    _UNARY[_op] = _fn
+del _op, _fn
+
+
+def _assign(context, id_, value):
+    slot = context.slot_index.get(id_)
+    if slot is None:
+        context.vars_[id_] = value
+    else:
+        context.slots[slot] = value
+        context.assigned[slot] = True
+    return value
+
+
+def _lookup(context, out):
+    if isinstance(out, tuple):
+        id_, value = out
+        return _assign(context, id_, value)
+    slot = context.slot_index.get(out)
+    if slot is not None:
+        return context.slots[slot]
+    return context.vars_.get(out, 0)
+
+
+def _sum(values):
+    try:
+        return sum(values)
+    except ValueError:
+        raise Exception("Invalid values summed.")
+
+
+def _call(program, context, func, args):
+    """Call the function under `func` the way `CALL` does, from a node that
+    isn't lowered.
+
+    The function is run by a new `execute`, so this recurses on Python's
+    stack like the tree engine does, and the same limits apply.
+    """
+    if func not in context.funcs:
+        raise Exception("Function `%d` not yet defined." % func)
+    function = context.funcs[func]
+    context.push_frame(args)
+    try:
+        cache = None
+        if function.reads is not None:
+            cache = context.call_cache(func, function)
+            key, value = cache.lookup(context.vars_)
+            if value is not MISS:
+                return value
+        budget = context.budget
+        if budget is not None:
+            budget.enter(context)
+        try:
+            value = execute(program, function, context)
+        finally:
+            if budget is not None:
+                budget.leave()
+    except RuntimeError as e:
+        if "recursion" not in str(e):
+            raise
+        # Python's stack ran out before the context's depth limit.
+        raise StackOverflow(len(context.frames))
+    finally:
+        context.pop_frame()
+    if cache is not None:
+        cache.store(key, value)
+    return value
+
+
+class _FallbackCall(CallOperation):
+    """A call in a node that's run by its tree walking `run()` method, made
+    to the lowered function rather than to a FunctionBlock."""
+    __slots__ = ("program", )
+
+    def __init__(self, call, program):
+        super(_FallbackCall, self).__init__()
+        self.body = call.body
+        self.position = call.position
+        self.program = program
+
+    def run(self, context):
+        out = self.body.run(context)
+        if isinstance(out, tuple):
+            func, args = out[0], out[1:]
+        else:
+            func, args = out, ()
+        return _call(self.program, context, func, args)
+
+
+def _handler(code, pc, error):
+    """Return the target and depth of the innermost handler of `error`
+    around the instruction running at `pc`, or None."""
+    found = None
+    for start, end, target, depth, exception in code.handlers:
+        if (start < pc <= end and isinstance(error, exception) and
+                (found is None or start >= found[0])):
+            found = start, target, depth
+    return found and found[1:]
+
+
+def execute(program, code, context):
+    """Run `code` and return the value it returns.
+
+    Calls don't recurse: the caller's code, position and hoisted values
+    are pushed onto `calls`, and the callee's values go on the same stack
+    above `base`, the height the stack had when it was called. Arguments
+    are passed as by `Context.push_frame`, with the caller's kept on
+    `context.frames`. `RETURN` and exceptions that the callee doesn't
+    handle pop them back off.
+    """
+    # Opcodes are compared as locals, which Python looks up much faster
+    # than globals.
+    (CONST, LOAD_SLOT, SET_SLOT, LOAD_VAR, SET_VAR, LOAD_HOIST, NE, NE_CONST,
+     JUMP_IF_ZERO, JUMP_IF_FALSE, JUMP, FOR_ITER, POP, DUP, POP_MATRIX, DOT,
+     LINE, ROTATE_CONST, TRANSLATE_CONST, CURSOR_CONST, SET_COLOR, HSL,
+     CURSOR, TRANSLATE, ROTATE, SCALE, CLEAR, SQRT, XOR) = _HOT
+    binary, unary = _BINARY, _UNARY
+    ops = code.ops
+    constants = program.constants
+    vars_ = context.vars_
+    funcs = context.funcs
+    frames = context.frames
+    max_depth = context.MAX_DEPTH
+    slots = context.slots
+    assigned = context.assigned
+    canvas = context.canvas
+    budget = context.budget
+    stack = []
+    push, pop = stack.append, stack.pop
+    hoists = [_UNSET] * code.hoists
+    pc = 0
+    base = 0
+    calls = []
+
+    while True:
+        try:
+            while True:
+                op = ops[pc]
+                pc += 1
+                # Ranges of opcodes are tested before the opcodes in them so
+                # that none is more than a few comparisons away.
+                if op <= LOAD_HOIST:
+                    if op == CONST:
+                        push(constants[ops[pc]])
+                        pc += 1
+                    elif op == LOAD_SLOT:
+                        push(slots[ops[pc]])
+                        pc += 1
+                    elif op == SET_SLOT:
+                        slots[ops[pc]] = pop()
+                        assigned[ops[pc]] = True
+                        pc += 1
+                    elif op == LOAD_VAR:
+                        push(vars_.get(constants[ops[pc]], 0))
+                        pc += 1
+                    elif op == SET_VAR:
+                        vars_[constants[ops[pc]]] = pop()
+                        pc += 1
+                    else:
+                        value = hoists[ops[pc]]
+                        if value is _UNSET:
+                            pc += 2
+                        else:
+                            push(value)
+                            pc = ops[pc + 1]
+
+                elif op <= NE_CONST:
+                    if op > NE:
+                        right = constants[ops[pc]]
+                        pc += 1
+                    else:
+                        right = pop()
+                    stack[-1] = binary[op](stack[-1], right)
+
+                elif op <= DUP:
+                    if op == FOR_ITER:
+                        remaining = stack[-1]
+                        if remaining:
+                            stack[-1] = remaining - 1
+                            pc = ops[pc]
+                            if budget is not None:
+                                budget.step(context)
+                        else:
+                            pc += 1
+                    elif op == JUMP_IF_ZERO:
+                        if pop() == 0:
+                            pc = ops[pc]
+                        else:
+                            pc += 1
+                    elif op == JUMP_IF_FALSE:
+                        if pop():
+                            pc += 1
+                        else:
+                            pc = ops[pc]
+                    elif op == JUMP:
+                        pc = ops[pc]
+                    elif op == POP:
+                        pop()
+                    else:
+                        push(stack[-1])
+
+                elif op <= POP_MATRIX:
+                    if op == DOT:
+                        canvas.dot()
+                    elif op == LINE:
+                        canvas.line()
+                    elif op == ROTATE_CONST:
+                        canvas.rotate(constants[ops[pc]])
+                        pc += 1
+                    elif op == TRANSLATE_CONST:
+                        canvas.translate(constants[ops[pc]],
+                                         constants[ops[pc + 1]])
+                        pc += 2
+                    elif op == CURSOR_CONST:
+                        canvas.set_cursor(constants[ops[pc]],
+                                          constants[ops[pc + 1]])
+                        pc += 2
+                    elif op == SET_COLOR:
+                        if ops[pc] == 4:
+                            a = pop()
+                            b = pop()
+                            g = pop()
+                            canvas.set_color(pop(), g, b, a, mode="rgba")
+                        else:
+                            b = pop()
+                            g = pop()
+                            canvas.set_color(pop(), g, b, mode="rgb")
+                        pc += 1
+                    elif op == HSL:
+                        if ops[pc] == 4:
+                            pop()
+                        l = pop()
+                        s = pop()
+                        canvas.set_color(*hsl_to_rgb(pop(), s, l), mode="rgb")
+                        pc += 1
+                    elif op == CURSOR:
+                        y = pop()
+                        canvas.set_cursor(pop(), y)
+                    elif op == TRANSLATE:
+                        y = pop()
+                        canvas.translate(pop(), y)
+                    elif op == ROTATE:
+                        canvas.rotate(pop())
+                    elif op == SCALE:
+                        y = pop()
+                        canvas.scale(pop(), y)
+                    elif op == CLEAR:
+                        canvas.clear_transforms()
+                    else:
+                        canvas.pop()
+
+                elif op <= SQRT:
+                    stack[-1] = unary[op](stack[-1])
+                elif op == XOR:
+                    right = pop()
+                    stack[-1] = bool(stack[-1]) != bool(right)
+
+                # Everything else is rare enough to be looked up globally.
+                elif op == AND_JUMP:
+                    if stack[-1] == 0:
+                        stack[-1] = 0
+                        pc = ops[pc]
+                    else:
+                        pop()
+                        pc += 1
+                elif op == OR_JUMP or op == ANY_JUMP:
+                    if stack[-1] != 0:
+                        pc = ops[pc]
+                    else:
+                        pop()
+                        pc += 1
+                elif op == SUM:
+                    count = ops[pc]
+                    pc += 1
+                    values = stack[len(stack) - count:]
+                    del stack[len(stack) - count:]
+                    push(_sum(values))
+                elif op == BUILD_TUPLE:
+                    count = ops[pc]
+                    pc += 1
+                    values = tuple(stack[len(stack) - count:])
+                    del stack[len(stack) - count:]
+                    push(values)
+                elif op == ASSIGN:
+                    stack[-1] = _lookup(context, stack[-1])
+                elif op == ASSIGN_KEY:
+                    value = pop()
+                    stack[-1] = _assign(context, stack[-1], value)
+                elif op == CALL:
+                    count = ops[pc]
+                    pc += 1
+                    if count:
+                        args = stack[len(stack) - count:]
+                        del stack[len(stack) - count:]
+                        func, args = args[0], args[1:]
+                    else:
+                        out = pop()
+                        if isinstance(out, tuple):
+                            func, args = out[0], out[1:]
+                        else:
+                            func, args = out, ()
+                    if func not in funcs:
+                        raise Exception("Function `%d` not yet defined." %
+                                        func)
+                    function = funcs[func]
+                    if frames:
+                        if len(frames) >= max_depth:
+                            raise StackOverflow(len(frames))
+                        saved = save_arguments(vars_, args)
+                    else:
+                        saved = None
+                        for idx, arg in enumerate(reversed(args)):
+                            vars_[(idx + 1) * -1] = arg
+                    cache = key = None
+                    if function.reads is not None:
+                        cache = context.call_cache(func, function)
+                        key, value = cache.lookup(vars_)
+                        if value is not MISS:
+                            if saved:
+                                restore_arguments(vars_, saved)
+                            push(value)
+                            continue
+                    frames.append(saved)
+                    calls.append((code, pc, hoists, base, cache, key))
+                    code, ops, pc, base = function, function.ops, 0, len(stack)
+                    hoists = [_UNSET] * code.hoists
+                    if budget is not None:
+                        budget.enter(context)
+                elif op == RETURN:
+                    value = pop()
+                    if value is None:
+                        value = 0
+                    if not calls:
+                        return value
+                    code, pc, hoists, base, cache, key = calls.pop()
+                    ops = code.ops
+                    saved = frames.pop()
+                    if saved:
+                        restore_arguments(vars_, saved)
+                    if budget is not None:
+                        budget.leave()
+                    if cache is not None:
+                        cache.store(key, value)
+                    push(value)
+                elif op == DEF_FUNC:
+                    context.funcs[pop()] = program.functions[ops[pc]]
+                    pc += 1
+                elif op == RAISE_BREAK:
+                    raise BreakInterrupt()
+                elif op == GET_ITER:
+                    stack[-1] = len(xrange(stack[-1]))
+                elif op == SET_HOIST:
+                    hoists[ops[pc]] = pop()
+                    pc += 1
+                elif op == UNSET_HOIST:
+                    hoists[ops[pc]] = _UNSET
+                    pc += 1
+                elif op == NODE:
+                    push(program.nodes[ops[pc]].run(context))
+                    pc += 1
+                else:
+                    raise ValueError("Unknown opcode %d at %d" % (op, pc - 1))
+        except Exception as e:
+            handler = _handler(code, pc, e)
+            # Return from calls that don't handle it until one does.
+            while handler is None:
+                if not calls:
+                    raise
+                del stack[base:]
+                code, pc, hoists, base, cache, key = calls.pop()
+                ops = code.ops
+                saved = frames.pop()
+                if saved:
+                    restore_arguments(vars_, saved)
+                if budget is not None:
+                    budget.leave()
+                handler = _handler(code, pc, e)
+            pc, depth = handler
+            del stack[base + depth:]
+
+
+def disassemble(program):
+    """Return a listing of the instructions in `program`."""
+    lines = []
+    for code in [program.main] + program.functions:
+        lines.append("%s:" % code.name)
+        ops = code.ops
+        pc = 0
+        while pc < len(ops):
+            op = ops[pc]
+            operands = []
+            for kind, operand in zip(OPERANDS[op], ops[pc + 1:]):
+                if kind == "const":
+                    operands.append("%d (%r)" % (operand,
+                                                 program.constants[operand]))
+                elif kind == "node":
+                    operands.append("%d (%r)" % (operand,
+                                                 program.nodes[operand]))
+                elif kind == "jump":
+                    operands.append("-> %d" % operand)
+                else:
+                    operands.append(str(operand))
+            lines.append("%6d  %-14s %s" % (pc, OPNAMES[op],
+                                            ", ".join(operands)))
+            pc += 1 + len(OPERANDS[op])
+        for start, end, target, depth, exception in code.handlers:
+            lines.append("        %s in %d-%d -> %d, depth %d" % (
+                exception.__name__, start, end, target, depth))
+        lines.append("")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    from interpreter import parse
+    from parser import ParserError
+
+    cli = argparse.ArgumentParser(description="Disassemble a GBC program.")
+    cli.add_argument("source", help="path to the program to disassemble")
+    cli.add_argument("--no-optimize", dest="optimize", action="store_false",
+                     help="lower the program without optimizing it first")
+    args = cli.parse_args()
+
+    with open(args.source) as file_:
+        try:
+            block = parse(file_.read(), args.optimize)
+        except ParserError as e:
+            sys.exit(str(e))
+    print disassemble(lower(block))